@@ -5,17 +5,126 @@
 
 __metaclass__ = type
 
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
 from ansible import constants as C
 from ansible.plugins.callback.default import CallbackModule as CallbackModuleDefault
+from ansible.utils.color import stringc
 from ansible.utils.display import Display
 from datetime import datetime
 
 
 class StderrDisplay(Display):
-
-    def display(self, msg, *args, **kwargs):
-        # Everything is displayed on stderr
-        return super(StderrDisplay, self).display(msg, stderr=True, *args, **kwargs)
+    """Display which sends everything to stderr. When `buffered`, messages
+    are queued (bounded queue, callers wait if it is full) and a writer
+    thread writes them in chunks, at most every `INTERVAL` seconds or
+    when `flush` is called.
+    """
+    QUEUE_SIZE = 10000
+    INTERVAL = 0.5
+    CHUNK = 64 * 1024
+
+    def __init__(self, buffered=False, *args, **kwargs):
+        super(StderrDisplay, self).__init__(*args, **kwargs)
+        self.queue = None
+        if buffered:
+            self.queue = queue.Queue(self.QUEUE_SIZE)
+            writer = threading.Thread(target=self._writer, name="concourse-display")
+            writer.daemon = True
+            writer.start()
+            # The writer dies with the process, stats are not reached
+            # when the run is aborted
+            atexit.register(self.flush)
+
+    def display(self, msg, color=None, stderr=False, screen_only=False, log_only=False):
+        if self.queue is None or log_only:
+            # Everything is displayed on stderr
+            return super(StderrDisplay, self).display(
+                msg, color=color, stderr=True, screen_only=screen_only, log_only=log_only)
+        text = stringc(msg, color) if color else msg
+        if not text.endswith(u'\n'):
+            text += u'\n'
+        self.queue.put(text)
+        if not screen_only:
+            super(StderrDisplay, self).display(msg, color=color, stderr=True, log_only=True)
+
+    def flush(self):
+        """Waits until the queued messages are written"""
+        if self.queue is not None:
+            done = threading.Event()
+            self.queue.put(done)
+            done.wait()
+
+    def _write(self, chunk):
+        try:
+            sys.stderr.write(u''.join(chunk))
+            sys.stderr.flush()
+        except IOError:
+            pass
+
+    def _writer(self):
+        while True:
+            chunk = [self.queue.get()]
+            size = 0
+            deadline = time.time() + self.INTERVAL
+            while not isinstance(chunk[-1], threading.Event) and size < self.CHUNK:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    chunk.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                if not isinstance(chunk[-1], threading.Event):
+                    size += len(chunk[-1])
+            events = [e for e in chunk if isinstance(e, threading.Event)]
+            self._write([m for m in chunk if not isinstance(m, threading.Event)])
+            for event in events:
+                event.set()
+
+
+class TaskProfiler(object):
+    """Records the start and end of each task on each host, as json lines
+    in `path`, and keeps the aggregated times to display the slowest ones.
+    """
+
+    def __init__(self, path):
+        self.output = open(path, 'a', buffering=1)
+        self.starts = {}
+        self.tasks = {}
+        self.hosts = {}
+
+    def start(self, task):
+        self.starts[task._uuid] = time.time()
+
+    def end(self, result, status):
+        end = time.time()
+        task = result._task
+        host = result._host.get_name()
+        start = self.starts.get(task._uuid, end)
+        name = task.get_name()
+        role = task._role.get_name() if task._role else None
+        self.output.write(json.dumps({
+            "task": name, "role": role, "host": host, "status": status,
+            "start": start, "end": end, "duration": end - start,
+        }) + '\n')
+        key = (task._uuid, "%s : %s" % (role, name) if role else name)
+        self.tasks[key] = max(self.tasks.get(key, 0), end - start)
+        self.hosts[host] = self.hosts.get(host, 0) + end - start
+
+    def slowest(self, top=10):
+        tasks = sorted(((d, k[1]) for k, d in self.tasks.items()), reverse=True)[:top]
+        hosts = sorted(((d, h) for h, d in self.hosts.items()), reverse=True)[:top]
+        return tasks, hosts
+
+    def close(self):
+        self.output.close()
 
 
 class CallbackModule(CallbackModuleDefault):
@@ -26,11 +135,27 @@ class CallbackModule(CallbackModuleDefault):
     CALLBACK_VERSION = 2.0
     CALLBACK_TYPE = 'stdout'
     CALLBACK_NAME = 'concourse'
+    # Path of the per task and host profile (json lines)
+    PROFILE = 'CONCOURSE_PROFILE'
+    # Output mode: default, buffered or summary (buffered without ok
+    # and skipped hosts)
+    DISPLAY_MODE = 'CONCOURSE_DISPLAY_MODE'
 
     def __init__(self):
         super(CallbackModule, self).__init__()
-        self._display = StderrDisplay()
+        self.display_mode = os.environ.get(self.DISPLAY_MODE, 'default')
+        self._display = StderrDisplay(buffered=self.display_mode in ('buffered', 'summary'))
         self.start_time = datetime.now()
+        self.profiler = None
+        profile = os.environ.get(self.PROFILE)
+        if profile:
+            self.profiler = TaskProfiler(profile)
+
+    def set_options(self, task_keys=None, var_options=None, direct=None):
+        super(CallbackModule, self).set_options(task_keys=task_keys, var_options=var_options, direct=direct)
+        if self.display_mode == 'summary':
+            self.display_ok_hosts = False
+            self.display_skipped_hosts = False
 
     def _human_runtime(self, runtime):
         minutes = (runtime.seconds // 60) % 60
@@ -42,13 +167,55 @@ class CallbackModule(CallbackModuleDefault):
         end_time = datetime.now()
         runtime = end_time - self.start_time
         self._display.display("Runtime: %s days, %s hours, %s minutes, %s seconds" % (self._human_runtime(runtime)))
+        if self.profiler:
+            tasks, hosts = self.profiler.slowest()
+            self._display.display("Slowest tasks:")
+            for duration, name in tasks:
+                self._display.display("  %9.2fs %s" % (duration, name))
+            self._display.display("Slowest hosts:")
+            for duration, name in hosts:
+                self._display.display("  %9.2fs %s" % (duration, name))
+            self.profiler.close()
+            self.profiler = None
+        self._display.flush()
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._display.flush()
+        if self.profiler:
+            self.profiler.start(task)
+        super(CallbackModule, self).v2_playbook_on_task_start(task, is_conditional)
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._display.flush()
+        if self.profiler:
+            self.profiler.start(task)
+        super(CallbackModule, self).v2_playbook_on_handler_task_start(task)
+
+    def v2_runner_on_ok(self, result):
+        if self.profiler:
+            self.profiler.end(result, "ok")
+        super(CallbackModule, self).v2_runner_on_ok(result)
+
+    def v2_runner_on_skipped(self, result):
+        if self.profiler:
+            self.profiler.end(result, "skipped")
+        super(CallbackModule, self).v2_runner_on_skipped(result)
+
+    def v2_runner_on_unreachable(self, result):
+        if self.profiler:
+            self.profiler.end(result, "unreachable")
+        super(CallbackModule, self).v2_runner_on_unreachable(result)
 
     def v2_runner_on_failed(self, result, ignore_errors=False):
+        if self.profiler:
+            self.profiler.end(result, "failed")
 
         delegated_vars = result._result.get('_ansible_delegated_vars', None)
         self._clean_results(result._result, result._task.action)
 
-        if self._play.strategy == 'free' and self._last_task_banner != result._task._uuid:
+        # The banner is not printed at task start with free strategy or summary mode
+        if (self._play.strategy == 'free' or not self.display_ok_hosts) and \
+                self._last_task_banner != result._task._uuid:
             self._print_task_banner(result._task)
 
         self._handle_exception(result._result, use_stderr=True)
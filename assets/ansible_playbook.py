@@ -4,21 +4,18 @@
 # concourse-ansible-resource - ansible_playbook.py
 # 03/04/2018
 
+import ast
+import gzip
+import hashlib
+import heapq
+import json
+import math
 import os
+import shlex
+import shutil
 import time
-from io import StringIO
 from resource import Resource
-from tempfile import NamedTemporaryFile
-
-from git import Repo
-from playbook_cli import PlaybookCLI
-
-try:
-    from __main__ import display
-except ImportError:
-    from ansible.utils.display import Display
-
-    display = Display()
+from tempfile import NamedTemporaryFile, gettempdir, mkdtemp
 
 
 class AnsiblePlaybook(Resource):
@@ -39,11 +36,34 @@ class AnsiblePlaybook(Resource):
         "forks": int,
         "tags": list,
         "skip_tags": list,
+        "fact_caching": bool,
+        "fact_caching_timeout": int,
+        "artifact_facts": bool,
+        "profile": bool,
+        "display_mode": str,
+        "strategy": str,
+        "shards": int,
+        "trace": bool,
+        "skip_unchanged": bool,
+        "skip_max_age": int,
+        "drift": bool,
+        "drift_playbook": str,
+        "drift_ttl": int,
+        "drift_forks": int,
+        "pipelining": bool,
+        "pipelining_probe": bool,
+        "sync": list,
+        "sync_parallel": int,
     }
     PARAMS = {
         # playbook
         "src": str,
         "playbook": str,
+        "playbooks": list,
+        "max_parallel": int,
+        "batch": str,
+        "batch_parallel": int,
+        "max_fail_percentage": float,
         "extra_vars": dict,
         "inventory": dict,
         "become": bool,
@@ -57,12 +77,77 @@ class AnsiblePlaybook(Resource):
         "forks": int,
         "tags": list,
         "skip_tags": list,
+        "fact_caching": bool,
+        "fact_caching_timeout": int,
+        "flush_cache": bool,
+        "artifact_facts": bool,
+        "profile": bool,
+        "display_mode": str,
+        "strategy": str,
+        "shards": int,
+        "trace": bool,
+        "skip_unchanged": bool,
+        "skip_max_age": int,
+        "limit": None,
+        "limit_changed": bool,
+        "pipelining": bool,
+        "pipelining_probe": bool,
+        "sync": list,
+        "sync_parallel": int,
     }
     DEFAULT_INVENTORY_FILE = "inventory.ini"
     DEFAULT_INVENTORY_PATH = "inventory"
+    # Extension of the inventory file for each format
+    INVENTORY_FORMATS = {"ini": ".ini", "json": ".json", "yaml": ".yml"}
+    INVENTORY_BUFFER = 1024 * 1024
+    INVENTORY_CACHE_FILE = "inventory.json"
+    INVENTORY_TIMEOUT = 300
+    GIT_TIMEOUT = 60
+    ARTIFACT_EXT = ".json.gz"
+    PROFILE_FILE = "profile.jsonl"
+    TRACE_FILE = "trace.json"
+    PROFILE_TOP = 5
+    DISPLAY_MODES = ["default", "buffered", "summary"]
+    # Strategy which runs the playbook on shards of hosts in parallel
+    SHARDED = "sharded"
+    SUMMARY_FILE = "hosts.json"
+    SUMMARY_TOP = 20
+    SUMMARY_COUNTS = ["ok", "changed", "failures", "unreachable", "skipped"]
+    METADATA_SIZE = 32 * 1024
+    METADATA_VALUE_SIZE = 4096
+    # Record of the last converged run (in cache_path), for skip_unchanged
+    LAST_RUN_FILE = "last_run.json"
+    # Settings which do not change what the playbook does
+    INPUTS_IGNORED = ["private_key_file", "skip_unchanged", "skip_max_age", "profile",
+                      "display_mode", "trace", "verbosity", "drift_ttl", "drift_forks",
+                      "pipelining", "pipelining_probe", "sync_parallel"]
+    HASH_BUFFER = 1024 * 1024
+    # Inline inventory of the last successful run (in cache_path), for limit_changed
+    LAST_INVENTORY_FILE = "last_inventory.json"
+    # Drift detection, results of each host kept in cache_path
+    DRIFT_PATH = "drift"
+    DRIFT_TTL = 3600
+    DRIFT_FORKS = 50
+    # Hosts probed for pipelining (sudo requiretty), kept in cache_path
+    PIPELINING_FILE = "pipelining.json"
+    PIPELINING_PROBE = """- name: Probe pipelining
+  hosts: all
+  gather_facts: false
+  become: true
+  tasks:
+  - ping:
+"""
+    # ssh operations of a module without pipelining: mkdir of the remote
+    # tmp folder, put of the module, chmod and run (with the rm)
+    SSH_OPS_SAVED = 3
+    # Folders pushed to the hosts with rsync before the playbook
+    SYNC_PARALLEL = 10
+    SYNC_TIMEOUT = 600
 
     def __init__(self, *args, **kwargs):
         super(self.__class__, self).__init__(*args, **kwargs)
+        # Additional results of the run, reported as metadata
+        self.report = {}
 
     def _get_config_param(self, data, params={}):
         config = {}
@@ -82,106 +167,268 @@ class AnsiblePlaybook(Resource):
                         self.logger.error(msg)
         return config
 
-    def _hosts_group(self, name, data_group, output):
+    @staticmethod
+    def _host_entry(host):
+        """Name and variables of an inventory host, a string like
+        "host1 ansible_port=2222" or a list like ["host1", "ansible_port=2222"].
+        """
+        tokens = host if isinstance(host, list) else shlex.split(str(host))
+        variables = {}
+        for token in tokens[1:]:
+            k, _, v = token.partition('=')
+            try:
+                variables[k] = ast.literal_eval(v)
+            except (ValueError, SyntaxError):
+                variables[k] = v
+        return tokens[0], variables
+
+    @staticmethod
+    def _ini_host(host):
+        if isinstance(host, list):
+            return ' '.join(host) + '\n'
+        return "%s\n" % host
+
+    def _ini_group(self, name, data_group, output):
         """It Processes a inventory group. It can be a host (string),
         a list of hosts (list of strings) or a dictionary.
         """
-        print("[%s]".format(name), file=output)
+        output.write("[%s]\n" % name)
         if isinstance(data_group, dict):
-            if "hosts" in data_group:
-                for host in data_group['hosts']:
-                    if isinstance(host, list):
-                        print(' '.join(host), file=output)
-                    else:
-                        print(host, file=output)
-            print('', file=output)
+            for host in data_group.get('hosts', []):
+                output.write(self._ini_host(host))
+            output.write('\n')
             if "vars" in data_group:
-                print("[%s:vars]" % name, file=output)
-                variables = data_group['vars']
+                output.write("[%s:vars]\n" % name)
                 try:
-                    for v in variables.keys():
-                        print("%s='%s'" % (v, variables[v]), file=output)
-                    print('', file=output)
+                    output.write(''.join(
+                        "%s='%s'\n" % (k, v) for k, v in data_group['vars'].items()))
                 except Exception as e:
                     msg = "Inventory vars exception %s: '%s'" % (name, str(e))
                     self.logger.error(msg)
-                print('', file=output)
+                output.write('\n')
             if "children" in data_group:
-                print("[%s:children]" % name, file=output)
-                for children in data_group['children']:
-                    print(children, file=output)
-                print('', file=output)
+                output.write("[%s:children]\n" % name)
+                output.write(''.join("%s\n" % c for c in data_group['children']))
+                output.write('\n')
         elif isinstance(data_group, list):
             for host in data_group:
-                if isinstance(host, list):
-                    print(' '.join(host), file=output)
-                else:
-                    print(host, file=output)
-            print('', file=output)
+                output.write(self._ini_host(host))
+            output.write('\n')
         else:
-            print(data_group, file=output)
-            print('', file=output)
-        print('', file=output)
+            output.write("%s\n\n" % data_group)
+        output.write('\n')
 
-    def hosts(self, data, path, hosts_file):
-        output = StringIO()
+    def _hosts_ini(self, data, output):
         if isinstance(data, dict):
-            # inventory is (json) dictionary as specified in
-            # http://docs.ansible.com/ansible/latest/dev_guide/developing_inventory.html
-            self.logger.debug("Processing json inventory: '%s'" % repr(data))
-            groups_children = [
-                g for g in data.keys()
-                if isinstance(data[g], dict) and 'children' in data[g]
-            ]
-            groups_leaf = [
-                g for g in data.keys()
-                if g not in groups_children
-            ]
-            for group in groups_children:
-                self._hosts_group(group, data[group], output)
-            for group in groups_leaf:
-                self._hosts_group(group, data[group], output)
+            # Groups with children first
+            for name, group in data.items():
+                if isinstance(group, dict) and 'children' in group:
+                    self._ini_group(name, group, output)
+            for name, group in data.items():
+                if not (isinstance(group, dict) and 'children' in group):
+                    self._ini_group(name, group, output)
         elif isinstance(data, list):
-            # inventory is a list of hosts
-            self.logger.debug("Processing list inventory: '%s'" % repr(data))
             for host in data:
-                if isinstance(host, list):
-                    print(' '.join(host), file=output)
-                else:
-                    print(host, file=output)
+                output.write(self._ini_host(host))
         else:
-            # inventory is something like "localhost"
-            msg = "Processing simple str inventory: '%s'" % repr(data)
-            self.logger.debug(msg)
-            print(data, file=output)
-        content = output.getvalue()
+            output.write("%s\n" % data)
+
+    def _native_group(self, data_group):
+        """Converts a group to the structure of the ansible yaml inventory"""
+        if isinstance(data_group, dict):
+            hosts = data_group.get('hosts', [])
+            group = {}
+            if "vars" in data_group:
+                group["vars"] = data_group["vars"]
+            if "children" in data_group:
+                group["children"] = dict((c, {}) for c in data_group["children"])
+        else:
+            hosts = data_group if isinstance(data_group, list) else [data_group]
+            group = {}
+        if hosts:
+            group["hosts"] = dict(self._host_entry(h) for h in hosts)
+        return group
+
+    def _hosts_native(self, data, output, fmt):
+        if isinstance(data, dict):
+            groups = data.items()
+        else:
+            groups = [("ungrouped", data)]
+        if fmt == "json":
+            output.write('{')
+            for n, (name, group) in enumerate(groups):
+                output.write(',\n' if n else '\n')
+                output.write(json.dumps(str(name)) + ': ')
+                json.dump(self._native_group(group), output)
+            output.write('\n}\n')
+        else:
+            import yaml
+            for name, group in groups:
+                yaml.safe_dump({str(name): self._native_group(group)}, output, default_flow_style=False)
+
+    def hosts(self, data, path, hosts_file, fmt="ini"):
+        """Writes the inventory `data` in `path`/`hosts_file`, directly to
+        the file, group by group. `fmt` is one of INVENTORY_FORMATS.
+        """
+        if fmt not in self.INVENTORY_FORMATS:
+            msg = "Invalid inventory format '%s'" % fmt
+            self.logger.error(msg)
+            raise ValueError(msg)
         inventory_path = os.path.join(path, hosts_file)
+        if isinstance(data, (dict, list)):
+            self.logger.debug("Rendering %s inventory with %d items" % (fmt, len(data)))
         try:
-            with open(inventory_path, 'w') as f:
-                f.write(content)
+            with open(inventory_path, 'w', buffering=self.INVENTORY_BUFFER) as f:
+                if fmt == "ini":
+                    self._hosts_ini(data, f)
+                else:
+                    self._hosts_native(data, f, fmt)
         except Exception as e:
             msg = "Cannot write inventory '%s': %s" % (inventory_path, str(e))
             self.logger.error(msg)
             raise
-        else:
-            output.close()
-        return content
+        return inventory_path
 
-    def inventory(self, workfolder, source, params):
-        output = None
-        inventory = source.get('inventory', {})
-        # Fixme! avoid overwriting
+    def _inventory_config(self, source, params):
+        inventory = dict(source.get('inventory', {}))
         inventory.update(params.get("inventory", {}))
+        return inventory
+
+    def _inventory_file(self, inventory):
+        """Name of the file created from the inventory hosts"""
+        inventory_file = inventory.get("file")
+        if not inventory_file:
+            inventory_file = os.path.splitext(self.DEFAULT_INVENTORY_FILE)[0]
+            inventory_file += self.INVENTORY_FORMATS.get(inventory.get("format", "ini"), "")
+        return inventory_file
+
+    def inventory_cache(self, workfolder, source, params):
+        """Returns the cache folder of the inventory, keyed by the hash of
+        the inventory definition and the files in its folder (and
+        subfolders). Dynamic inventories, `executable` or executable files
+        in the folder, are only cached with a `cache_ttl`.
+        """
+        cache_path = source.get("cache_path")
+        inventory = self._inventory_config(source, params)
+        ttl = inventory.get("cache_ttl")
+        if not cache_path or (inventory.get("executable") and not ttl):
+            return None
+        digest = hashlib.sha1(json.dumps(inventory, sort_keys=True, default=str).encode('utf-8'))
+        inventory_path = os.path.join(workfolder, inventory.get("path", self.DEFAULT_INVENTORY_PATH))
+        inventory_file = os.path.join(inventory_path, self._inventory_file(inventory))
+        for root, dirs, files in os.walk(inventory_path):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                if not os.path.isfile(path) or (inventory.get("hosts") and path == inventory_file):
+                    continue
+                if os.access(path, os.X_OK) and not ttl:
+                    self.logger.info("Inventory '%s' is executable, not cached without cache_ttl" % path)
+                    return None
+                digest.update(os.path.relpath(path, inventory_path).encode('utf-8'))
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+        cache = os.path.join(cache_path, "inventory", digest.hexdigest())
+        if not os.path.exists(cache):
+            os.makedirs(cache)
+        cache_file = os.path.join(cache, self.INVENTORY_CACHE_FILE)
+        if ttl and os.path.isfile(cache_file) and time.time() - os.stat(cache_file).st_mtime > int(ttl):
+            self.logger.info("Inventory cache '%s' expired" % cache_file)
+            os.remove(cache_file)
+        return cache
+
+    def _run_inventory(self, executable, timeout):
+        rcode, stdout, stderr = self.process([os.path.abspath(executable), "--list"], timeout=timeout)
+        if rcode != 0:
+            raise ValueError("rcode %d: %s" % (rcode, stderr.strip()))
+        if not isinstance(json.loads(stdout), dict):
+            raise ValueError("output is not a json dictionary")
+        return stdout
+
+    @staticmethod
+    def _executables(executables):
+        """Inventory executables as a list of {"path", "timeout"}"""
+        if not isinstance(executables, list):
+            executables = [executables]
+        return [e if isinstance(e, dict) else {"path": e} for e in executables]
+
+    def dynamic_inventory(self, executables, path, cache_path, timeout):
+        """Runs the inventory executables in parallel, each one with its own
+        timeout. If one fails its last successful output (kept in the cache)
+        is used. Returns the list of inventory sources, which are scripts
+        returning the output of each executable.
+        """
+        executables = self._executables(executables)
+        cache = os.path.join(cache_path, "inventory", "executables")
+        for folder in [path, cache]:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+        status = {}
+        sources = []
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=len(executables)) as executor:
+            futures = [
+                executor.submit(self._run_inventory, e["path"], int(e.get("timeout", timeout)))
+                for e in executables
+            ]
+            for n, (executable, future) in enumerate(zip(executables, futures)):
+                name = executable["path"]
+                cached = os.path.join(cache, hashlib.sha1(name.encode('utf-8')).hexdigest() + ".json")
+                output = os.path.join(path, ".dynamic%d.json" % n)
+                try:
+                    content = future.result()
+                except Exception as e:
+                    msg = "Inventory executable '%s' failed: %s" % (name, str(e))
+                    self.logger.error(msg)
+                    if not os.path.isfile(cached):
+                        status[name] = "failed"
+                        continue
+                    age = time.time() - os.stat(cached).st_mtime
+                    status[name] = "stale (%ds)" % age
+                    shutil.copyfile(cached, output)
+                else:
+                    status[name] = "ok"
+                    with open(output, 'w') as f:
+                        f.write(content)
+                    shutil.copyfile(output, cached)
+                # Script for the inventory plugin, --host is only called
+                # when the output has no _meta
+                script = os.path.join(path, "dynamic%d.sh" % n)
+                with open(script, 'w') as f:
+                    f.write("#!/bin/sh\n")
+                    f.write('[ "$1" = "--host" ] && exec %s "$@"\n' % shlex.quote(os.path.abspath(name)))
+                    f.write("cat %s\n" % shlex.quote(os.path.abspath(output)))
+                os.chmod(script, 0o755)
+                sources.append(script)
+        self.report["inventory_sources"] = status
+        if not sources:
+            msg = "All the inventory executables failed"
+            self.logger.error(msg)
+            raise ValueError(msg)
+        return sources
+
+    def inventory(self, workfolder, source, params, cache=None):
+        output = None
+        inventory = self._inventory_config(source, params)
         hosts = inventory.get("hosts")
         inventory_path = inventory.get("path", self.DEFAULT_INVENTORY_PATH)
         inventory_file = inventory.get("file")
         inventory_exec = inventory.get("executable")
+        inventory_format = inventory.get("format", "ini")
         # TODO
         group_vars = inventory.get("group_vars")
         host_vars = inventory.get("host_vars")
         if inventory_exec:
-            # dynamic inventory executable
-            output = inventory_exec
+            # dynamic inventory executables
+            inventory_exec = self._executables(inventory_exec)
+            if cache and os.path.isfile(os.path.join(cache, self.INVENTORY_CACHE_FILE)):
+                output = [e["path"] for e in inventory_exec]
+            else:
+                inventory_path = os.path.join(workfolder, inventory_path)
+                output = self.dynamic_inventory(
+                    inventory_exec, inventory_path, source.get("cache_path", gettempdir()),
+                    inventory.get("timeout", self.INVENTORY_TIMEOUT))
         else:
             inventory_path = os.path.join(workfolder, inventory_path)
             if not os.path.exists(inventory_path):
@@ -197,29 +444,270 @@ class AnsiblePlaybook(Resource):
             else:
                 # Inventory is the full path
                 # Just create a inventory file
-                inventory_file = self.DEFAULT_INVENTORY_FILE
+                inventory_file = self._inventory_file(inventory)
                 output = inventory_path
             if hosts:
-                self.hosts(hosts, inventory_path, inventory_file)
+                cached = os.path.join(cache, "rendered-" + inventory_file) if cache else None
+                if cached and os.path.isfile(cached):
+                    # Same inventory already rendered
+                    shutil.copyfile(cached, os.path.join(inventory_path, inventory_file))
+                else:
+                    rendered = self.hosts(hosts, inventory_path, inventory_file, inventory_format)
+                    if cached:
+                        shutil.copyfile(rendered, cached)
         return output
 
+    def _inventory_state(self, data):
+        """Groups of the inline inventory `data` with their hosts (and
+        variables), variables and children, as json types.
+        """
+        groups = data.items() if isinstance(data, dict) else [("ungrouped", data)]
+        state = dict((str(name), self._native_group(group)) for name, group in groups)
+        return json.loads(json.dumps(state, sort_keys=True, default=str))
+
+    @staticmethod
+    def changed_hosts(previous, current):
+        """Hosts and groups of the `current` inventory state which are new
+        or different in the `previous` one: hosts with other variables or
+        groups and groups with other variables or children (all the hosts
+        of a group are in the limit).
+        """
+        def memberships(state):
+            hosts = {}
+            for group, data in state.items():
+                for host, variables in data.get("hosts", {}).items():
+                    hosts.setdefault(host, []).append([group, variables])
+            return hosts
+
+        before = memberships(previous)
+        changed = []
+        for host, groups in memberships(current).items():
+            if sorted(groups) != sorted(before.get(host, [])):
+                changed.append(host)
+        for group, data in current.items():
+            old = previous.get(group)
+            if old is None or any(data.get(k) != old.get(k) for k in ("vars", "children")):
+                changed.append(group)
+        return sorted(set(changed))
+
+    def _inventory_inputs(self, folder, source, params, config):
+        # Hash of the inputs of the run except the inline inventory
+        inventory = self._inventory_config(source, params)
+        rendered = os.path.join(
+            config["build_path"], inventory.get("path", self.DEFAULT_INVENTORY_PATH), self._inventory_file(inventory))
+        return self.inputs_hash(folder, dict(config, inventory_cache=None), exclude=[rendered])
+
+    def limit_changed(self, source, params, inputs):
+        """Subset of the run with the hosts and groups of the inline
+        inventory changed since the last successful run, or None (all the
+        hosts) without a previous inventory, without changes or when the
+        other `inputs` (playbooks, variables) changed.
+        """
+        hosts = self._inventory_config(source, params).get("hosts")
+        cache_path = source.get("cache_path")
+        if not hosts or not cache_path:
+            self.logger.warning("limit_changed needs an inline inventory and cache_path, ignoring it")
+            return None
+        path = os.path.join(cache_path, self.LAST_INVENTORY_FILE)
+        try:
+            with open(path) as f:
+                previous = json.load(f)
+        except (IOError, ValueError):
+            self.logger.info("No previous inventory, running on all the hosts")
+            return None
+        if previous.get("inputs") != inputs:
+            self.logger.info("Playbooks or variables changed, running on all the hosts")
+            return None
+        changed = self.changed_hosts(previous["inventory"], self._inventory_state(hosts))
+        if not changed:
+            self.logger.info("Inventory unchanged, running on all the hosts")
+            return None
+        self.logger.info("Limiting the run to %d changed hosts and groups", len(changed))
+        self.report["limit"] = changed
+        return ','.join(changed)
+
+    def save_inventory_state(self, source, params, inputs):
+        """Keeps the inline inventory and the other `inputs` of a
+        successful run, for limit_changed
+        """
+        hosts = self._inventory_config(source, params).get("hosts")
+        cache_path = source.get("cache_path")
+        if not hosts or not cache_path:
+            return None
+        path = os.path.join(cache_path, self.LAST_INVENTORY_FILE)
+        if not os.path.exists(cache_path):
+            os.makedirs(cache_path)
+        with open(path + ".tmp", 'w') as f:
+            json.dump({"inputs": inputs, "inventory": self._inventory_state(hosts)}, f)
+        os.rename(path + ".tmp", path)
+        return path
+
+    def _git_identity(self, source):
+        src_private_key = source.get("src_private_key")
+        if src_private_key:
+            git_ssh_identity_filename = os.path.expanduser("~/.ssh/id_rsa")
+            with open(git_ssh_identity_filename, "w") as f:
+                f.write(src_private_key)
+            os.chmod(git_ssh_identity_filename, 0o600)
+
+    def _ls_remote(self, uri, branch):
+        cmd = ["git", "ls-remote", uri, "refs/heads/%s" % branch]
+        rcode, stdout, stderr = self.process(cmd, timeout=self.GIT_TIMEOUT)
+        if rcode != 0:
+            msg = "Cannot get refs of '%s': %s" % (uri, stderr.strip())
+            self.logger.error(msg)
+            raise ValueError(msg)
+        if not stdout.strip():
+            msg = "Branch '%s' not found in '%s'" % (branch, uri)
+            self.logger.error(msg)
+            raise ValueError(msg)
+        return stdout.split()[0]
+
+    def _commits(self, source, ref, current, paths):
+        """Commits from `current` to `ref` changing `paths`, oldest first"""
+        from git import Repo
+        from git_mirror import GitMirror
+
+        cache_path = source.get("cache_path", gettempdir())
+        mirror = GitMirror(cache_path, self.logger).update(source.get("src_uri"))
+        git = Repo(mirror).git
+        if current:
+            try:
+                commits = git.log("--format=%H", "--reverse", "%s..%s" % (current, ref), "--", *paths)
+                return commits.split()
+            except Exception as e:
+                # current version is not in the history anymore
+                self.logger.warning("Cannot get commits since '%s': %s" % (current, str(e)))
+        return git.log("--format=%H", "-1", ref, "--", *paths).split()
+
+    def check(self, source, version):
+        """Versions are the commits of `src_branch` in `src_uri`, the remote
+        branch head is queried without cloning. With `paths` only the
+        commits changing them are versions, which needs a mirror of the
+        repository (kept in `cache_path`).
+        """
+        if source.get("drift"):
+            return self.drift(source, version)
+        if not source.get("src_uri"):
+            return super(self.__class__, self).check(source, version)
+        self._git_identity(source)
+        ref = self._ls_remote(source["src_uri"], source.get("src_branch", "master"))
+        current = (version or {}).get("ref")
+        if ref == current:
+            return 0, [version]
+        paths = source.get("paths")
+        if not paths:
+            return 0, [{"ref": ref}]
+        versions = [{"ref": c} for c in self._commits(source, ref, current, paths)]
+        if not versions and current:
+            versions = [version]
+        return 0, versions
+
+    def drift(self, source, version):
+        """Drift detection: the playbook (`drift_playbook`) runs in check
+        and diff mode on the hosts not checked in the last `drift_ttl`
+        seconds. The changes pending on each host are kept in `cache_path`
+        while the playbooks and inventory do not change. Versions are the
+        sets of hosts with changes pending, the hosts are in the `drift`
+        piece of the artifact of each version.
+        """
+        from playbook_cli import PlaybookCLI
+
+        cache_path = source.get("cache_path")
+        if not cache_path:
+            msg = "Drift detection needs cache_path"
+            self.logger.error(msg)
+            raise ValueError(msg)
+        workfolder = mkdtemp(prefix="drift")
+        try:
+            config = self.configure(workfolder, source, {"playbook": source.get("drift_playbook", "playbook.yml")})
+            digest = self.inputs_hash(workfolder, config)
+            folder = os.path.join(cache_path, self.DRIFT_PATH)
+            path = os.path.join(folder, digest + ".json")
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            try:
+                with open(path) as f:
+                    results = json.load(f)
+            except (IOError, ValueError):
+                # Other playbooks or inventory, previous results are not valid
+                for name in os.listdir(folder):
+                    os.remove(os.path.join(folder, name))
+                results = {}
+            now = time.time()
+            ttl = config.get("drift_ttl", self.DRIFT_TTL)
+            hosts = PlaybookCLI(config, self.logger).list_hosts()
+            stale = [h for h in hosts if now - results.get(h, {}).get("timestamp", 0) > ttl]
+            self.logger.info("Checking drift of %d hosts (%d checked in the last %ds)",
+                             len(stale), len(hosts) - len(stale), ttl)
+            if stale:
+                config.update(check=True, diff=True, subset=','.join(stale))
+                config['forks'] = config.get("drift_forks", self.DRIFT_FORKS)
+                os.environ["CONCOURSE_DISPLAY_MODE"] = config.get("display_mode", "summary")
+                exitcode, stats, report = self.run_playbook(config)
+                for host in stats.processed:
+                    counts = stats.summarize(host)
+                    # Unreachable hosts are checked again the next time
+                    if not counts["unreachable"]:
+                        results[host] = {"timestamp": now, "changed": counts["changed"], "failures": counts["failures"]}
+                with open(path + ".tmp", 'w') as f:
+                    json.dump(results, f)
+                os.rename(path + ".tmp", path)
+        finally:
+            shutil.rmtree(workfolder, ignore_errors=True)
+        drifting = sorted(h for h in hosts if results.get(h, {}).get("changed"))
+        version = {
+            "drift": hashlib.sha1(json.dumps(drifting).encode('utf-8')).hexdigest(),
+            "hosts": str(len(drifting)),
+        }
+        if not os.path.isdir(self._artifact_path(cache_path, version)):
+            metadata = [
+                {"name": "hosts_drift", "value": str(len(drifting))},
+                {"name": "top_drift", "value": self._metadata_value(drifting[:self.SUMMARY_TOP])},
+            ]
+            self.save_artifact(cache_path, version, {
+                "summary": {"statuscode": 0, "version": version, "metadata": metadata},
+                "drift": dict((h, results[h]) for h in drifting),
+            })
+        return 0, [version]
+
+    def clone(self, source, build_path):
+        from git import Repo
+        from git_mirror import GitMirror
+
+        src_uri = source.get("src_uri")
+        src_branch = source.get("src_branch", "master")
+        src_depth = source.get("src_depth")
+        if src_depth:
+            src_depth = int(src_depth)
+        cache_path = source.get("cache_path")
+        if cache_path:
+            mirror = GitMirror(cache_path, self.logger)
+            return mirror.clone(src_uri, build_path, src_branch, src_depth)
+        if src_depth:
+            return Repo.clone_from(
+                src_uri, build_path, branch=src_branch,
+                depth=src_depth, single_branch=True)
+        return Repo.clone_from(src_uri, build_path, branch=src_branch)
+
     def configure(self, workfolder, source, params):
         config = self._get_config_param(source, self.SOURCE)
         private_key_path = config.get("private_key_file")
         config_params = self._get_config_param(params, self.PARAMS)
         config.update(config_params)
+        # 0 (stop on the first failure) is dropped with the empty values
+        if params.get("max_fail_percentage") is not None:
+            config['max_fail_percentage'] = float(params["max_fail_percentage"])
         # Path
         build_path = config_params.get("src")
         if build_path:
             build_path = os.path.join(workfolder, build_path)
         else:
             build_path = os.path.join(workfolder, "src")
-            git_ssh_identity_filename = os.path.expanduser("~/.ssh/id_rsa")
-            git_ssh_identity_file = open(git_ssh_identity_filename, "w")
-            git_ssh_identity_file.write(source.get("src_private_key"))
-            git_ssh_identity_file.close()
-            os.chmod(git_ssh_identity_filename, 0o600)
-            Repo.clone_from(source.get("src_uri"), build_path, branch=source.get("src_branch", "master"))
+            self._git_identity(source)
+            with self.tracer.span("clone"):
+                self.clone(source, build_path)
+        config['build_path'] = build_path
 
         # Extra vars (just a dictionary)
         extra_vars = config.get("extra_vars", {})
@@ -240,63 +728,689 @@ class AnsiblePlaybook(Resource):
             config['private_key_file'] = private_key_path
         elif private_key_path:
             config['private_key_file'] = os.path.join(build_path, private_key_path)
+        # Facts cache
+        if config.get("fact_caching"):
+            cache_path = source.get("cache_path", workfolder)
+            config['fact_caching'] = os.path.join(cache_path, "facts")
+        # Timing profile written by the concourse callback
+        if config.get("profile"):
+            config['profile'] = os.path.join(workfolder, self.PROFILE_FILE)
+            if os.path.exists(config['profile']):
+                os.remove(config['profile'])
+        # Output of the concourse callback
+        display_mode = config.get("display_mode", "default")
+        if display_mode not in self.DISPLAY_MODES:
+            msg = "Invalid display_mode '%s', must be one of %s" % (display_mode, self.DISPLAY_MODES)
+            self.logger.error(msg)
+            raise ValueError(msg)
+        if config.get("strategy") == self.SHARDED and config.get("batch"):
+            msg = "Strategy '%s' cannot be used with batch" % self.SHARDED
+            self.logger.error(msg)
+            raise ValueError(msg)
+        # Hosts of the run
+        limit = config.pop("limit", None)
+        if limit and config.get("limit_changed"):
+            msg = "limit cannot be used with limit_changed"
+            self.logger.error(msg)
+            raise ValueError(msg)
+        if limit:
+            config['subset'] = ','.join(limit) if isinstance(limit, list) else str(limit)
         # Inventory
-        config['inventory'] = self.inventory(build_path, source, params)
-        # Playbook path
-        playbook_path = params.get("playbook", "playbook.yml")
-        playbook_path = os.path.join(build_path, playbook_path)
+        inventory_cache = self.inventory_cache(build_path, source, params)
+        with self.tracer.span("inventory"):
+            config['inventory'] = self.inventory(build_path, source, params, inventory_cache)
+        if inventory_cache:
+            config['inventory_cache'] = os.path.join(inventory_cache, self.INVENTORY_CACHE_FILE)
+        # List of playbooks, with dependencies between them, or playbook path
+        playbooks = params.get("playbooks")
+        if not playbooks:
+            config['playbook'] = self._playbook_path(build_path, params.get("playbook", "playbook.yml"))
+        else:
+            config['playbooks'] = []
+            for playbook in playbooks:
+                if not isinstance(playbook, dict):
+                    playbook = {"playbook": playbook}
+                config['playbooks'].append({
+                    "name": playbook["playbook"],
+                    "path": self._playbook_path(build_path, playbook["playbook"]),
+                    "requires": playbook.get("requires", []),
+                })
+        return config
+
+    def _playbook_path(self, build_path, playbook):
+        playbook_path = os.path.join(build_path, playbook)
         if not os.path.isfile(playbook_path):
             msg = "Cannot find playbook file '%s'" % (playbook_path)
             self.logger.error(msg)
             raise ValueError(msg)
-        config['playbook'] = playbook_path
-        return config
+        return playbook_path
+
+    @staticmethod
+    def _errors(stats):
+        # Number of hosts with failed tasks or unreachable
+        return sum(1 for h in stats.processed if stats.failures.get(h) or stats.dark.get(h))
+
+    def summarize(self, stats, path=None, top=SUMMARY_TOP, pipelined=None):
+        """Aggregated counts of the run and the `top` hosts with more
+        failed (and unreachable) tasks. With `path`, the results of each
+        host are written there as json. With the `pipelined` hosts (ssh
+        connections with pipelining), the ssh operations saved are estimated.
+        """
+        totals = dict((k, 0) for k in self.SUMMARY_COUNTS)
+        hosts = {"changed": 0, "failed": [], "unreachable": []}
+        saved = 0
+        output = open(path, 'w') if path else None
+        try:
+            if output:
+                output.write('{')
+            for n, h in enumerate(stats.processed):
+                s = stats.summarize(h)
+                for k in totals:
+                    totals[k] += s[k]
+                if s["changed"] > 0:
+                    hosts["changed"] += 1
+                if s["failures"] > 0:
+                    hosts["failed"].append((s["failures"], h))
+                if s["unreachable"] > 0:
+                    hosts["unreachable"].append((s["unreachable"], h))
+                if pipelined is not None and h in pipelined:
+                    saved += self.SSH_OPS_SAVED * (s["ok"] + s["failures"])
+                if output:
+                    output.write('%s\n%s: %s' % (',' if n else '', json.dumps(h), json.dumps(s)))
+            if output:
+                output.write('}\n')
+        finally:
+            if output:
+                output.close()
+
+        def largest(items):
+            return [h for count, h in heapq.nsmallest(top, items, key=lambda i: (-i[0], i[1]))]
 
-    def summarize(self, stats):
-        failed = []
-        unreachable = []
-        hosts = stats.processed.keys()
-        for h in hosts:
-            s = stats.summarize(h)
-            if s["failures"] > 0:
-                failed.append(h)
-            if s["unreachable"] > 0:
-                unreachable.append(h)
         result = {
-            "hosts_all": hosts,
-            "hosts_failed": failed,
-            "hosts_unreachable": unreachable,
-            "processed": stats.processed,
-            "failures": stats.failures,
-            "ok": stats.ok,
-            "dark": stats.dark,
-            "changed": stats.changed,
-            "skipped": stats.skipped
+            "hosts": len(stats.processed),
+            "hosts_changed": hosts["changed"],
+            "hosts_failed": len(hosts["failed"]),
+            "hosts_unreachable": len(hosts["unreachable"]),
+            "top_failed": largest(hosts["failed"]),
+            "top_unreachable": largest(hosts["unreachable"]),
         }
-        self.logger.info("Playbook summary: %s" % (result))
+        result.update(totals)
+        if pipelined is not None:
+            result["ssh_ops_saved"] = saved
+        if path:
+            result["hosts_file"] = path
+        self.logger.info("Playbook summary: %s", result)
         return result
 
-    def metadata(self, rcode, result):
+    def statuscode(self, rcode, result):
         if rcode == 0:
             statuscode = 0
-            if len(result.get("hosts_failed", [])) > 0:
+            if result.get("hosts_failed", 0) > 0 or result.get("sync_failed"):
                 statuscode = 2
-            if len(result.get("hosts_unreachable", [])) > 0:
+            if result.get("hosts_unreachable", 0) > 0:
                 statuscode = 3
         else:
             statuscode = rcode
-        metadata = []
+        return statuscode
+
+    def _metadata_value(self, value):
+        if not isinstance(value, str):
+            value = json.dumps(value, sort_keys=True)
+        if len(value) > self.METADATA_VALUE_SIZE:
+            value = value[:self.METADATA_VALUE_SIZE - 3] + "..."
+        return value
+
+    def metadata(self, rcode, result):
+        """Metadata entries of the result, json encoded. Each value is
+        truncated to METADATA_VALUE_SIZE and entries are dropped once the
+        whole metadata is over METADATA_SIZE.
+        """
+        statuscode = self.statuscode(rcode, result)
+        metadata = [{"name": "statuscode", "value": str(statuscode)}]
+        size = len(metadata[0]["value"])
+        dropped = []
         for k in result.keys():
-            metadata.append({"name": str(k), "value": str(result[k])})
-        metadata.append({"name": "statuscode", "value": str(statuscode)})
+            value = self._metadata_value(result[k])
+            if size + len(k) + len(value) > self.METADATA_SIZE:
+                dropped.append(str(k))
+                continue
+            size += len(k) + len(value)
+            metadata.append({"name": str(k), "value": value})
+        if dropped:
+            self.logger.warning("Metadata too large, dropped entries: %s" % dropped)
         return statuscode, metadata
 
+    def profile(self, path, top=PROFILE_TOP):
+        """Reads the json lines profile written by the concourse callback
+        and returns the `top` slowest tasks and hosts (in seconds).
+        """
+        tasks = {}
+        hosts = {}
+        with open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+                name = entry["task"]
+                if entry.get("role"):
+                    name = "%s : %s" % (entry["role"], name)
+                tasks[name] = max(tasks.get(name, 0), entry["duration"])
+                hosts[entry["host"]] = hosts.get(entry["host"], 0) + entry["duration"]
+
+        def slowest(durations):
+            items = sorted(durations.items(), key=lambda i: i[1], reverse=True)
+            return [[k, round(v, 3)] for k, v in items[:top]]
+
+        return {"slowest_tasks": slowest(tasks), "slowest_hosts": slowest(hosts)}
+
+    def ssh_broker(self, source, config):
+        """Starts (or reuses) the ssh connection broker and points ansible
+        ssh connections to its ControlMaster sockets.
+        """
+        from ssh_broker import SSHBroker
+
+        cache_path = source.get("cache_path", gettempdir())
+        idle = int(source.get("ssh_broker_idle", SSHBroker.IDLE))
+        broker = SSHBroker(os.path.join(cache_path, "ssh"), self.logger, idle)
+        private_key = source.get("private_key")
+        if not private_key and config.get("private_key_file"):
+            with open(config["private_key_file"]) as f:
+                private_key = f.read()
+        control_dir = broker.control_dir(private_key)
+        broker.start()
+        self.report["ssh_connections_reused"] = broker.warm(control_dir)
+        os.environ["ANSIBLE_SSH_ARGS"] = broker.ssh_args(control_dir)
+        return broker, control_dir
+
+    def pipelining(self, source, config):
+        """Hosts of the run which cannot use pipelining, sudo with
+        `requiretty` fails without a tty. With `pipelining_probe` and
+        become, a play pings the hosts not probed yet (kept in
+        `cache_path`) with become and pipelining.
+        """
+        if not (config.get("pipelining_probe") and config.get("become")):
+            return []
+        from playbook_cli import PlaybookCLI
+
+        probed = {}
+        path = os.path.join(source["cache_path"], self.PIPELINING_FILE) if source.get("cache_path") else None
+        if path and os.path.isfile(path):
+            with open(path) as f:
+                probed = json.load(f)
+        hosts = [h for h in PlaybookCLI(config, self.logger).list_hosts() if h not in probed]
+        if hosts:
+            with NamedTemporaryFile('w', suffix='.yml') as probe:
+                probe.write(self.PIPELINING_PROBE)
+                probe.flush()
+                # One play on all the hosts, in this process
+                probe_config = dict(config, playbook=probe.name, subset=','.join(hosts), no_pipelining=[])
+                for k in ("strategy", "batch", "shards", "playbooks"):
+                    probe_config.pop(k, None)
+                with self.tracer.span("pipelining_probe"):
+                    exitcode, stats, report = self._run_cli(probe_config)
+            for host in stats.processed:
+                counts = stats.summarize(host)
+                # Unreachable hosts are probed again the next time
+                if not counts["unreachable"]:
+                    probed[host] = counts["failures"] == 0
+            self.report["pipelining_probed"] = len(hosts)
+            if path:
+                with open(path + ".tmp", 'w') as f:
+                    json.dump(probed, f)
+                os.rename(path + ".tmp", path)
+        fallback = sorted(h for h, ok in probed.items() if not ok)
+        if fallback:
+            self.logger.warning("Pipelining disabled on %d hosts (sudo requiretty)", len(fallback))
+            self.report["pipelining_fallback"] = fallback
+        return fallback
+
+    def _rsync_command(self, src, dest, connection, config):
+        """rsync of the contents of `src` to `dest` on a host, through ssh
+        with the key, user and ssh arguments of ansible
+        """
+        from ansible import constants as C
+
+        command = ["rsync", "-az", "--stats"]
+        if connection["connection"] == "local":
+            # Relative to the home folder, as with ssh
+            dest = os.path.join(os.path.expanduser("~"), dest)
+            if not os.path.exists(dest):
+                os.makedirs(dest)
+            return command + [src + "/", dest]
+        ssh = ["ssh", "-o", "BatchMode=yes", "-o", "ConnectTimeout=%d" % config.get("timeout", 10)]
+        if not C.HOST_KEY_CHECKING:
+            ssh += ["-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null"]
+        # ControlMaster sockets of the ssh broker
+        ssh += shlex.split(os.environ.get("ANSIBLE_SSH_ARGS", ""))
+        ssh += shlex.split(config.get("ssh_common_args", ""))
+        if connection["port"]:
+            ssh += ["-p", str(connection["port"])]
+        if connection["private_key_file"]:
+            ssh += ["-i", connection["private_key_file"]]
+        target = "%s@%s:%s" % (connection["user"], connection["host"], dest)
+        return command + [
+            "--protect-args", "-e", ' '.join(shlex.quote(arg) for arg in ssh),
+            "--rsync-path", "mkdir -p %s && rsync" % shlex.quote(dest),
+            src + "/", target,
+        ]
+
+    def sync(self, config):
+        """Pushes the `sync` folders of the playbooks folder (`src`, to
+        `dest` on the hosts) to the hosts of the run with rsync, up to
+        `sync_parallel` hosts at the same time. Returns the bytes sent and
+        seconds spent on each host.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from playbook_cli import PlaybookCLI
+
+        folders = []
+        for item in config["sync"]:
+            if not isinstance(item, dict):
+                item = {"src": item}
+            src = os.path.join(config["build_path"], item["src"])
+            if not os.path.isdir(src):
+                msg = "Cannot find sync folder '%s'" % src
+                self.logger.error(msg)
+                raise ValueError(msg)
+            folders.append((src, item.get("dest", item["src"])))
+        connections = PlaybookCLI(config, self.logger).connections()
+
+        def push(host):
+            start = time.time()
+            sent = 0
+            for src, dest in folders:
+                if connections[host]["connection"] not in ("ssh", "smart", "local"):
+                    raise ValueError("connection '%s' not supported" % connections[host]["connection"])
+                command = self._rsync_command(src, dest, connections[host], config)
+                rcode, stdout, stderr = self.process(command, timeout=self.SYNC_TIMEOUT)
+                if rcode != 0:
+                    raise ValueError("rcode %d: %s" % (rcode, stderr.strip()))
+                for line in stdout.splitlines():
+                    if line.startswith("Total bytes sent:"):
+                        sent += int(line.split(':')[1].strip().replace(',', '').replace('.', ''))
+            return {"bytes": sent, "duration": round(time.time() - start, 3)}
+
+        results = {}
+        parallel = config.get("sync_parallel", self.SYNC_PARALLEL)
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = [(host, executor.submit(push, host)) for host in sorted(connections)]
+            for host, future in futures:
+                try:
+                    results[host] = future.result()
+                except Exception as e:
+                    self.logger.error("Cannot sync host '%s': %s" % (host, str(e)))
+                    results[host] = {"error": str(e)}
+        failed = sorted(h for h, r in results.items() if "error" in r)
+        self.report["sync"] = results
+        self.report["sync_bytes"] = sum(r.get("bytes", 0) for r in results.values())
+        if failed:
+            self.report["sync_failed"] = failed
+        return results
+
+    @staticmethod
+    def _merge_report(report, other):
+        # Counters of several runs are added up, dictionaries merged
+        for k, v in other.items():
+            if isinstance(v, int) and isinstance(report.get(k), int):
+                report[k] += v
+            elif isinstance(v, dict) and isinstance(report.get(k), dict):
+                report[k].update(v)
+            elif isinstance(v, list) and isinstance(report.get(k), list):
+                report[k].extend(v)
+            else:
+                report[k] = v
+
+    def _run_cli(self, config):
+        # ansible (and git) are only imported when needed, check and in
+        # have to start fast
+        from playbook_cli import PlaybookCLI
+
+        if config.get("strategy") == self.SHARDED:
+            # Not an ansible strategy, shards run with the default one
+            config = dict(config, strategy=None)
+        cli = PlaybookCLI(config, self.logger)
+        exitcode, stdout, stats = cli.run()
+        return exitcode, stats, cli.report
+
+    def run_playbook(self, config):
+        if config.get("strategy") == self.SHARDED:
+            return self.run_batches(config, config.get("shards") or os.cpu_count())
+        if config.get("batch"):
+            return self.run_batches(config)
+        return self._run_cli(config)
+
+    def _batch_size(self, batch, total):
+        try:
+            if batch.endswith('%'):
+                size = int(math.ceil(total * float(batch[:-1]) / 100))
+            else:
+                size = int(batch)
+        except ValueError as e:
+            msg = "Invalid batch '%s': %s" % (batch, str(e))
+            self.logger.error(msg)
+            raise ValueError(msg)
+        return max(1, size)
+
+    def run_batches(self, config, shards=None):
+        """Runs the playbook on batches of hosts, up to `batch_parallel`
+        batches at the same time. Pending batches are skipped once the
+        percentage of failed hosts is over `max_fail_percentage`.
+
+        With `shards`, the hosts are split in that number of batches, all
+        of them running at the same time with the default strategy.
+        """
+        from playbook_cli import PlaybookCLI
+        from playbook_pool import PlaybookPool
+
+        hosts = PlaybookCLI(config, self.logger).list_hosts()
+        if shards:
+            size = max(1, int(math.ceil(len(hosts) / float(shards))))
+            parallel = shards
+            kind = "shard"
+        else:
+            size = self._batch_size(config["batch"], len(hosts))
+            parallel = config.get("batch_parallel", 1)
+            kind = "batch"
+        jobs = []
+        for n, i in enumerate(range(0, len(hosts), size)):
+            batch_config = dict(config)
+            batch_config['subset'] = ','.join(hosts[i:i + size])
+            if shards:
+                batch_config['strategy'] = None
+            jobs.append({"name": "%s%d" % (kind, n), "args": batch_config, "hosts": len(hosts[i:i + size])})
+        max_fail = config.get("max_fail_percentage")
+
+        def failed(value):
+            exitcode, stats, report = value
+            return self._errors(stats)
+
+        def stop(results):
+            if max_fail is None:
+                return False
+            done = [job for job in jobs if results.get(job['name']) is not None]
+            total = sum(job['hosts'] for job in done)
+            if total == 0:
+                return False
+            errors = 0
+            for job in done:
+                value = results[job['name']]
+                errors += job['hosts'] if isinstance(value, Exception) else failed(value)
+            return errors * 100.0 / total > max_fail
+
+        pool = PlaybookPool(self.logger, parallel)
+        results = pool.run(jobs, self._run_cli, stop=stop)
+        exitcode = 0
+        stats_list = []
+        batches = []
+        report = {}
+        for job in jobs:
+            value = results[job['name']]
+            batch = {"hosts": job['hosts']}
+            if value is None:
+                batch["status"] = "skipped"
+            elif isinstance(value, Exception):
+                batch["status"] = 1
+                exitcode = 1
+            else:
+                rcode, stats, batch_report = value
+                batch["status"] = self.statuscode(rcode, self.summarize(stats))
+                batch["failed"] = round(failed(value) * 100.0 / job['hosts'], 2)
+                exitcode = max(exitcode, rcode)
+                stats_list.append(stats)
+                self._merge_report(report, batch_report)
+            if job['name'] in pool.durations:
+                batch["duration"] = round(pool.durations[job['name']], 3)
+            batches.append(batch)
+        report["shards" if shards else "batches"] = batches
+        return exitcode, PlaybookCLI.merge_stats(stats_list), report
+
+    def run_playbooks(self, config, playbooks):
+        """Runs the playbooks in parallel processes (up to `max_parallel`),
+        a playbook only runs once all the ones it requires have finished
+        successfully. Returns the exit code and the aggregated stats.
+        """
+        from playbook_cli import PlaybookCLI
+        from playbook_pool import PlaybookPool
+
+        jobs = []
+        for playbook in playbooks:
+            playbook_config = dict(config)
+            playbook_config['playbook'] = playbook['path']
+            jobs.append({
+                "name": playbook['name'],
+                "requires": playbook['requires'],
+                "args": playbook_config,
+            })
+        status = {}
+
+        def ok(value):
+            if isinstance(value, Exception):
+                return False
+            exitcode, stats, report = value
+            return self.statuscode(exitcode, self.summarize(stats)) == 0
+
+        pool = PlaybookPool(self.logger, config.get("max_parallel", 1))
+        results = pool.run(jobs, self.run_playbook, ok=ok)
+        exitcode = 0
+        stats_list = []
+        for name in [job['name'] for job in jobs]:
+            value = results[name]
+            if value is None:
+                status[name] = "skipped"
+            elif isinstance(value, Exception):
+                status[name] = 1
+                exitcode = 1
+            else:
+                rcode, stats, report = value
+                status[name] = self.statuscode(rcode, self.summarize(stats))
+                exitcode = max(exitcode, rcode)
+                stats_list.append(stats)
+                self._merge_report(self.report, report)
+        self.report["playbooks"] = status
+        return exitcode, PlaybookCLI.merge_stats(stats_list)
+
+    def _artifact_path(self, cache_path, version):
+        key = json.dumps(version, sort_keys=True)
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(cache_path, "artifacts", name)
+
+    def save_artifact(self, cache_path, version, artifact):
+        """Stores each piece of the artifact of a version as gzipped json"""
+        path = self._artifact_path(cache_path, version)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for piece, content in artifact.items():
+            with gzip.open(os.path.join(path, piece + self.ARTIFACT_EXT), 'wt') as f:
+                json.dump(content, f)
+        self.logger.info("Artifact of version %s saved in '%s'" % (version, path))
+        return path
+
+    def fetch(self, dir, source, version, params):
+        """Copies the requested pieces (`artifacts` param, by default only
+        the summary) of the artifact of the version to `dir`.
+        """
+        metadata = []
+        pieces = params.get("artifacts", ["summary"])
+        cache_path = source.get("cache_path")
+        path = self._artifact_path(cache_path, version) if cache_path else None
+        if not path or not os.path.isdir(path):
+            self.logger.warning("No artifact for version %s" % version)
+            return 0, {"version": version, "metadata": metadata}
+        for piece in pieces:
+            artifact = os.path.join(path, piece + self.ARTIFACT_EXT)
+            if not os.path.isfile(artifact):
+                self.logger.warning("No '%s' in the artifact of version %s" % (piece, version))
+                continue
+            with gzip.open(artifact, 'rb') as fsrc:
+                with open(os.path.join(dir, piece + ".json"), 'wb') as fdst:
+                    shutil.copyfileobj(fsrc, fdst)
+            if piece == "summary":
+                with gzip.open(artifact, 'rt') as f:
+                    metadata = json.load(f).get("metadata", [])
+        return 0, {"version": version, "metadata": metadata}
+
+    def inputs_hash(self, folder, config, dynamic=False, exclude=()):
+        """Hash of everything which defines the run: the files of the
+        playbooks folder (with the rendered inventory) but the `exclude`
+        ones, the cached output of the `dynamic` inventory and the
+        configuration (extra vars, params).
+        """
+        digest = hashlib.sha1()
+        settings = dict((k, v) for k, v in config.items() if k not in self.INPUTS_IGNORED)
+        # Paths are relative to the build folder, which changes every build
+        settings = json.dumps(settings, sort_keys=True, default=str).replace(folder, "")
+        digest.update(settings.encode('utf-8'))
+        # Outputs of the run and scripts generated for the dynamic
+        # inventories (absolute paths, their output is in the inventory folder)
+        generated = [os.path.join(folder, f) for f in (self.SUMMARY_FILE, self.PROFILE_FILE, self.TRACE_FILE)]
+        if isinstance(config.get("inventory"), list):
+            generated.extend(config["inventory"])
+        generated.extend(exclude)
+        generated = set(os.path.normpath(path) for path in generated)
+        files = []
+        for root, dirs, names in os.walk(config["build_path"]):
+            dirs[:] = [d for d in dirs if d != ".git"]
+            files.extend(os.path.normpath(os.path.join(root, n)) for n in names)
+        if dynamic and config.get("inventory_cache"):
+            files.append(config["inventory_cache"])
+        for path in sorted(files):
+            if path in generated or not os.path.isfile(path):
+                continue
+            digest.update(os.path.relpath(path, folder).encode('utf-8'))
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.HASH_BUFFER), b''):
+                    digest.update(chunk)
+        return digest.hexdigest()
+
+    def last_run(self, cache_path, digest, max_age=None):
+        """Version and metadata of the last run when it was converged
+        (no changes) with the same inputs `digest`, and not older than
+        `max_age` seconds.
+        """
+        path = os.path.join(cache_path, self.LAST_RUN_FILE)
+        try:
+            with open(path) as f:
+                record = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if record.get("hash") != digest:
+            self.logger.info("Inputs changed since the last converged run")
+            return None
+        age = time.time() - record["timestamp"]
+        if max_age and age > max_age:
+            self.logger.info("Last converged run is %ds old, running to converge" % age)
+            return None
+        self.logger.info("Inputs unchanged since version %s, skipping run" % record["version"])
+        metadata = list(record["metadata"])
+        metadata.insert(1, {"name": "skipped_run", "value": "unchanged for %ds" % age})
+        return {"version": record["version"], "metadata": metadata}
+
+    def save_last_run(self, cache_path, digest, rcode, result, rvalue):
+        """Keeps the record of a successful run without changes, any
+        other result removes it so the next run is not skipped.
+        """
+        path = os.path.join(cache_path, self.LAST_RUN_FILE)
+        if rcode != 0 or result.get("hosts_changed", 0) > 0:
+            if os.path.exists(path):
+                os.remove(path)
+            return None
+        record = {"hash": digest, "timestamp": time.time()}
+        record.update(rvalue)
+        if not os.path.exists(cache_path):
+            os.makedirs(cache_path)
+        with open(path + ".tmp", 'w') as f:
+            json.dump(record, f)
+        os.rename(path + ".tmp", path)
+        return path
+
     def update(self, folder, source, params):
-        config = self.configure(folder, source, params)
-        exitcode, stdout, stats = PlaybookCLI(config, self.logger).run()
-        result = self.summarize(stats)
+        with self.tracer.span("configure"):
+            config = self.configure(folder, source, params)
+        digest = None
+        if config.get("skip_unchanged"):
+            if source.get("cache_path"):
+                with self.tracer.span("inputs_hash"):
+                    dynamic = bool(self._inventory_config(source, params).get("executable"))
+                    digest = self.inputs_hash(folder, config, dynamic)
+                previous = self.last_run(source["cache_path"], digest, config.get("skip_max_age"))
+                if previous:
+                    return 0, previous
+            else:
+                self.logger.warning("skip_unchanged needs cache_path, ignoring it")
+        inputs = None
+        if config.get("limit_changed"):
+            inputs = self._inventory_inputs(folder, source, params, config)
+            config['subset'] = self.limit_changed(source, params, inputs)
+        broker = None
+        if source.get("ssh_broker", False):
+            with self.tracer.span("ssh_broker"):
+                broker, control_dir = self.ssh_broker(source, config)
+        pipelined = None
+        if config.get("pipelining"):
+            from playbook_cli import PlaybookCLI
+
+            fallback = config['no_pipelining'] = self.pipelining(source, config)
+            # Only ssh connections save operations with pipelining
+            pipelined = set(
+                h for h, c in PlaybookCLI(config, self.logger).connections().items()
+                if c["connection"] in ("ssh", "smart") and h not in fallback)
+        if config.get("sync"):
+            with self.tracer.span("sync"):
+                results = self.sync(config)
+            failed = self.report.get("sync_failed")
+            if failed:
+                if len(failed) == len(results):
+                    msg = "Cannot sync any host"
+                    self.logger.error(msg)
+                    raise ValueError(msg)
+                # The playbook does not run on the hosts without the sync folders
+                config['subset'] = ','.join([config.get('subset') or 'all'] + ['!' + h for h in failed])
+        if config.get("profile"):
+            os.environ["CONCOURSE_PROFILE"] = config["profile"]
+        if config.get("display_mode"):
+            os.environ["CONCOURSE_DISPLAY_MODE"] = config["display_mode"]
+        playbooks = config.get("playbooks")
+        with self.tracer.span("run"):
+            if playbooks:
+                exitcode, stats = self.run_playbooks(config, playbooks)
+            else:
+                exitcode, stats, report = self.run_playbook(config)
+                self._merge_report(self.report, report)
+        if broker:
+            broker.touch(control_dir)
+        if config.get("profile") and os.path.isfile(config["profile"]):
+            self.report.update(self.profile(config["profile"]))
+            self.report["profile"] = config["profile"]
+        with self.tracer.span("summarize"):
+            result = self.summarize(stats, os.path.join(folder, self.SUMMARY_FILE), pipelined=pipelined)
+        facts = self.report.pop("facts", None)
+        # Spans of the playbook runs (other processes)
+        self.tracer.events.extend(self.report.pop("trace", []))
+        result.update(self.report)
+        if self.tracer.enabled:
+            for name, duration in sorted(self.tracer.durations().items()):
+                result["time_" + name] = round(duration, 3)
+            result["trace_file"] = os.path.join(folder, self.TRACE_FILE)
         rcode, metadata = self.metadata(exitcode, result)
         timestamp = time.time()
         version = {"timestamp": str(timestamp)}
         rvalue = {"version": version, "metadata": metadata}
+        if source.get("cache_path"):
+            with open(result["hosts_file"]) as f:
+                hosts = json.load(f)
+            artifact = {
+                "summary": {"statuscode": rcode, "version": version, "metadata": metadata},
+                "hosts": hosts,
+            }
+            if facts is not None:
+                artifact["facts"] = facts
+            if "profile" in self.report:
+                with open(self.report["profile"]) as f:
+                    artifact["profile"] = [json.loads(line) for line in f]
+            with self.tracer.span("artifact"):
+                self.save_artifact(source["cache_path"], version, artifact)
+        if rcode == 0 and inputs:
+            self.save_inventory_state(source, params, inputs)
+        if digest:
+            self.save_last_run(source["cache_path"], digest, rcode, result, rvalue)
+        if self.tracer.enabled:
+            self.tracer.save(result["trace_file"])
         return rcode, rvalue
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 :
+
+# concourse-ansible-resource - forkserver.py
+# 18/10/2026
+
+import sys
+import time
+
+import argparse
+import array
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+
+
+class ForkServer(object):
+    """Keeps ansible (and its plugins) imported in a server process which
+    forks a child for each resource request received on a unix socket.
+    The request carries the command, arguments, folder and environment,
+    plus stdin, stdout and stderr of the client (SCM_RIGHTS), so the child
+    runs as if it was the client process.
+    """
+    ENV = "CONCOURSE_ANSIBLE_FORKSERVER"
+    IDLE = 3600
+    INTERVAL = 5
+    HEADER = struct.Struct('!I')
+    STATUS = struct.Struct('!i')
+    # Status sent when the request cannot be served, the client runs it
+    REFUSED = -1
+
+    def __init__(self, path, logger, idle=IDLE):
+        self.path = path
+        self.logger = logger
+        self.idle = idle
+        self.children = set()
+
+    @staticmethod
+    def _ansible_env(env):
+        # ansible constants are read when imported, requests need the
+        # same ansible settings than the server
+        return dict((k, v) for k, v in env.items() if k.startswith("ANSIBLE_"))
+
+    def preload(self):
+        from ansible import constants as C
+        from ansible.plugins.loader import callback_loader, connection_loader, strategy_loader
+        import ansible_playbook
+        import playbook_cli
+
+        for loader, name in (
+                (strategy_loader, C.DEFAULT_STRATEGY),
+                (connection_loader, 'ssh'),
+                (connection_loader, 'local'),
+                (callback_loader, C.DEFAULT_STDOUT_CALLBACK)):
+            try:
+                loader.get(name, class_only=True)
+            except Exception as e:
+                self.logger.warning("Cannot preload plugin '%s': %s" % (name, str(e)))
+        self.logger.info("Preloaded %d modules" % len(sys.modules))
+
+    @classmethod
+    def _receive(cls, conn):
+        fds = array.array('i')
+        data, ancdata, flags, addr = conn.recvmsg(65536, socket.CMSG_SPACE(3 * fds.itemsize))
+        for level, kind, cmsg in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(cmsg[:len(cmsg) - (len(cmsg) % fds.itemsize)])
+        if len(data) < cls.HEADER.size:
+            raise ValueError("Invalid request header")
+        size = cls.HEADER.unpack(data[:cls.HEADER.size])[0]
+        data = data[cls.HEADER.size:]
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                raise ValueError("Incomplete request")
+            data += chunk
+        return json.loads(data.decode('utf-8')), list(fds)
+
+    def _reap(self):
+        for pid in list(self.children):
+            try:
+                done, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done = pid
+            if done:
+                self.children.discard(pid)
+
+    def _child(self, server, conn, request, fds):
+        server.close()
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        for n, fd in enumerate(fds):
+            os.dup2(fd, n)
+            os.close(fd)
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        sys.argv = request["argv"]
+        rcode = 1
+        try:
+            rcode = run(request["command"], request["argv"][1:])
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            try:
+                conn.sendall(self.STATUS.pack(rcode))
+            finally:
+                os._exit(rcode)
+
+    def handle(self, server, conn):
+        try:
+            request, fds = self._receive(conn)
+        except Exception as e:
+            self.logger.error("Invalid request: %s" % str(e))
+            return
+        if len(fds) != 3 or self._ansible_env(request["env"]) != self._ansible_env(os.environ):
+            self.logger.warning("Refusing request, different ansible settings")
+            for fd in fds:
+                os.close(fd)
+            conn.sendall(self.STATUS.pack(self.REFUSED))
+            return
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self._child(server, conn, request, fds)
+        for fd in fds:
+            os.close(fd)
+        self.children.add(pid)
+        self.logger.info("Request '%s' served by pid=%d" % (request["command"], pid))
+
+    def serve(self):
+        """Server loop, it finishes after `idle` seconds without requests"""
+        self.preload()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        os.chmod(self.path, 0o600)
+        server.listen(16)
+        server.settimeout(self.INTERVAL)
+        self.logger.info("Fork server listening on '%s'" % self.path)
+        used = time.time()
+        try:
+            while self.children or time.time() - used < self.idle:
+                try:
+                    conn, addr = server.accept()
+                except socket.timeout:
+                    self._reap()
+                    continue
+                used = time.time()
+                with conn:
+                    conn.settimeout(None)
+                    self.handle(server, conn)
+                self._reap()
+        finally:
+            server.close()
+            os.remove(self.path)
+        self.logger.info("Fork server finished")
+
+    @classmethod
+    def request(cls, command, argv, path=None):
+        """Sends the request to the server in `path` (by default the
+        socket in the ENV variable) and returns the exit code, or None
+        if there is no server or it cannot serve the request.
+        """
+        path = path or os.environ.get(cls.ENV)
+        if not path or not os.path.exists(path):
+            return None
+        request = json.dumps({
+            "command": command,
+            "argv": argv,
+            "cwd": os.getcwd(),
+            "env": dict(os.environ),
+        }).encode('utf-8')
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(path)
+            fds = array.array('i', [sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno()])
+            client.sendmsg(
+                [cls.HEADER.pack(len(request)) + request],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+        except OSError:
+            client.close()
+            return None
+        with client:
+            data = b''
+            while len(data) < cls.STATUS.size:
+                chunk = client.recv(cls.STATUS.size - len(data))
+                if not chunk:
+                    # The child died without status
+                    return 1
+                data += chunk
+        rcode = cls.STATUS.unpack(data)[0]
+        return None if rcode == cls.REFUSED else rcode
+
+
+def run(command, arguments=None):
+    """Runs a resource command as the check, in and out scripts"""
+    from ansible_playbook import AnsiblePlaybook
+
+    r = AnsiblePlaybook(arguments)
+    try:
+        rcode = r.run(command)
+    except Exception as e:
+        sys.stderr.write("ERROR: " + str(e) + "\n")
+        rcode = 1
+    return rcode
+
+
+if __name__ == '__main__':
+    from ansible.utils.display import Display
+
+    display = Display()
+    parser = argparse.ArgumentParser(description=ForkServer.__doc__)
+    parser.add_argument('path')
+    parser.add_argument('--idle', type=int, default=ForkServer.IDLE)
+    args = parser.parse_args()
+    # ansible display can have configured the root logger already
+    handler = logging.FileHandler(args.path + ".log")
+    handler.setFormatter(logging.Formatter('%(asctime)s %(name)s: %(message)s'))
+    logger = logging.getLogger(ForkServer.__name__)
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    server = ForkServer(args.path, logger, args.idle)
+    server.serve()
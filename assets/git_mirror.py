@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 :
+
+# concourse-ansible-resource - git_mirror.py
+# 18/10/2026
+
+import fcntl
+import hashlib
+import os
+
+from git import Repo
+
+
+class GitMirror(object):
+    """Keeps a bare mirror of a git repository in a cache folder, so each
+    build only fetches the new objects and checks out the branch locally.
+    """
+    MIRRORS_PATH = "git"
+
+    def __init__(self, cache_path, logger):
+        self.logger = logger
+        self.path = os.path.join(cache_path, self.MIRRORS_PATH)
+
+    def mirror_path(self, uri):
+        name = hashlib.sha1(uri.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, name + ".git")
+
+    def update(self, uri):
+        """Creates the bare mirror of `uri` or fetches the delta if it
+        is already in the cache. Returns the mirror path.
+        """
+        mirror = self.mirror_path(uri)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        # Other builds can share the same cache volume
+        with open(mirror + ".lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.isdir(mirror):
+                self.logger.info("Fetching '%s' into mirror '%s'" % (uri, mirror))
+                repo = Repo(mirror)
+                repo.remotes.origin.set_url(uri)
+                repo.remotes.origin.fetch(prune=True)
+            else:
+                self.logger.info("Creating mirror of '%s' in '%s'" % (uri, mirror))
+                Repo.clone_from(uri, mirror, mirror=True)
+        return mirror
+
+    def clone(self, uri, path, branch="master", depth=None):
+        """Checks out `branch` of `uri` in `path` using the local mirror
+        as source. With `depth` a shallow, single branch clone is done,
+        otherwise the objects are shared with the mirror.
+        """
+        mirror = self.update(uri)
+        if depth:
+            repo = Repo.clone_from(
+                "file://" + mirror, path, branch=branch,
+                depth=depth, single_branch=True)
+        else:
+            repo = Repo.clone_from(mirror, path, branch=branch, shared=True)
+        repo.remotes.origin.set_url(uri)
+        return repo
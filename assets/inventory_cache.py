@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 :
+
+# concourse-ansible-resource - inventory_cache.py
+# 18/10/2026
+
+import json
+import os
+from tempfile import NamedTemporaryFile
+
+from ansible.inventory.manager import InventoryManager
+
+try:
+    from __main__ import display
+except ImportError:
+    from ansible.utils.display import Display
+
+    display = Display()
+
+# Variables with paths of the build which filled the cache
+PATH_VARS = ("inventory_file", "inventory_dir")
+
+
+class CachedInventoryManager(InventoryManager):
+    """InventoryManager which keeps the parsed inventory (groups, hosts
+    and their variables) in a compact json file. When the file exists the
+    inventory is built from it instead of parsing the sources.
+    """
+
+    def __init__(self, loader, sources=None, cache=None):
+        self._cache_file = cache
+        self.cache_hit = False
+        super(CachedInventoryManager, self).__init__(loader=loader, sources=sources)
+
+    def parse_sources(self, cache=False):
+        # refresh_inventory (cache=False) always parses the sources
+        if cache and self._cache_file and os.path.isfile(self._cache_file):
+            try:
+                self._load_cache()
+            except Exception as e:
+                display.warning("Cannot load inventory cache '%s': %s" % (self._cache_file, str(e)))
+            else:
+                self.cache_hit = True
+                return
+        super(CachedInventoryManager, self).parse_sources(cache=cache)
+        if self._cache_file:
+            try:
+                self._save_cache()
+            except Exception as e:
+                display.warning("Cannot save inventory cache '%s': %s" % (self._cache_file, str(e)))
+
+    def _root(self):
+        # Folder of the first source, paths of the cache are relative to it
+        if not self._sources:
+            return os.getcwd()
+        return os.path.dirname(os.path.abspath(self._sources[0]))
+
+    def _save_cache(self):
+        root = self._root()
+        data = {"groups": {}, "hosts": {}}
+        for name, group in self._inventory.groups.items():
+            data["groups"][name] = {
+                "vars": group.vars,
+                "children": [g.name for g in group.child_groups],
+                "hosts": [h.name for h in group.hosts],
+            }
+        for name, host in self._inventory.hosts.items():
+            variables = dict((k, v) for k, v in host.vars.items() if k not in PATH_VARS)
+            paths = dict((k, os.path.relpath(host.vars[k], root)) for k in PATH_VARS if host.vars.get(k))
+            data["hosts"][name] = {"vars": variables, "paths": paths, "address": host.address}
+        # Several processes can be using the same cache
+        path = os.path.dirname(self._cache_file)
+        with NamedTemporaryFile('w', dir=path, delete=False) as f:
+            json.dump(data, f)
+        os.rename(f.name, self._cache_file)
+
+    def _load_cache(self):
+        with open(self._cache_file) as f:
+            data = json.load(f)
+        root = self._root()
+        inventory = self._inventory
+        for name, host in data["hosts"].items():
+            inventory.add_host(name)
+            inventory.hosts[name].vars = host["vars"]
+            for k, path in host["paths"].items():
+                inventory.hosts[name].vars[k] = os.path.normpath(os.path.join(root, path))
+            inventory.hosts[name].address = host["address"]
+        for name, group in data["groups"].items():
+            inventory.add_group(name)
+            for k, v in group["vars"].items():
+                inventory.set_variable(name, k, v)
+        for name, group in data["groups"].items():
+            for child in group["children"]:
+                inventory.add_child(name, child)
+            for host in group["hosts"]:
+                inventory.add_child(name, host)
+        inventory.reconcile_inventory()
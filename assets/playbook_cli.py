@@ -5,17 +5,26 @@
 # 03/04/2018
 
 
+import logging
 from collections import namedtuple
 
+from ansible import constants as C
 from ansible.cli import CLI
 from ansible.errors import AnsibleError
+from ansible.executor.stats import AggregateStats
 from ansible.executor.playbook_executor import PlaybookExecutor
 from ansible.inventory.manager import InventoryManager
 from ansible.module_utils._text import to_bytes
 from ansible.parsing.dataloader import DataLoader
 from ansible.parsing.vault import VaultSecret
+from ansible.playbook.play import Play
+from ansible.playbook.play_context import PlayContext
+from ansible.template import Templar
 from ansible.utils.vars import load_extra_vars, load_options_vars
 from ansible.vars.manager import VariableManager
+from inventory_cache import CachedInventoryManager
+from resource import redact
+from tracer import Tracer
 
 try:
     from __main__ import display
@@ -28,6 +37,7 @@ except ImportError:
 class PlaybookCLI(CLI):
     DEFAULTS = {
         'subset': None,
+        'artifact_facts': False,
         'ask_pass': False,
         'ask_vault_pass': False,
         'become': False,
@@ -39,16 +49,21 @@ class PlaybookCLI(CLI):
         'connection': 'smart',
         'diff': False,
         'extra_vars': [],
+        'fact_caching': None,
+        'fact_caching_timeout': 86400,
         'flush_cache': False,
         'force_handlers': False,
         'forks': 5,
         'inventory': None,
+        'inventory_cache': None,
         'listhosts': False,
         'listtags': False,
         'listtasks': False,
         'module_path': None,
         'new_vault_password_file': None,
+        'no_pipelining': [],
         'output_file': None,
+        'pipelining': False,
         'private_key_file': None,
         'remote_user': 'root',
         'remote_pass': None,
@@ -59,9 +74,11 @@ class PlaybookCLI(CLI):
         'ssh_extra_args': '',
         'start_at_task': None,
         'step': None,
+        'strategy': None,
         'syntax': False,  # None
         'tags': ['all'],
         'timeout': 10,
+        'trace': False,
         'vault_password': None,
         'vault_password_file': None,
         'verbosity': 0,
@@ -76,6 +93,9 @@ class PlaybookCLI(CLI):
         # del options_all['module_path']
         #  Convert dictionary to namedtuple 'Options'
         self.options = namedtuple('Options', options.keys())(**options)
+        # Additional results of the run
+        self.report = {}
+        self.tracer = Tracer(enabled=self.options.trace)
 
     def parse(self):
         pass
@@ -83,7 +103,6 @@ class PlaybookCLI(CLI):
     def run(self):
         rcode = 0
         playbook_path = self.options.playbook
-        inventory_path = self.options.inventory
         vault_password = self.options.vault_password
         become_password = self.options.become_pass
         remote_password = self.options.remote_pass
@@ -100,7 +119,12 @@ class PlaybookCLI(CLI):
             loader.set_basedir(basedir)
 
         # create the inventory, and filter it based on the subset specified (if any)
-        inventory = InventoryManager(loader=loader, sources=inventory_path)
+        with self.tracer.span("parse_inventory"):
+            inventory = self._inventory(loader)
+
+        # facts cache has to be setup before the variable manager
+        if self.options.fact_caching:
+            PlaybookCLI._fact_caching(self.options.fact_caching, self.options.fact_caching_timeout)
 
         # create the variable manager, which will be shared throughout
         # the code, ensuring a consistent view of global variables
@@ -122,35 +146,65 @@ class PlaybookCLI(CLI):
             passwords['become_pass'] = become_password
         if remote_password is not None:
             passwords['conn_pass'] = remote_password
-        self.logger.info("Running playbook '%s': %s" % (playbook_path, self.options))
+        self.logger.info("Running playbook '%s'" % playbook_path)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Options: %s", redact(self.options._asdict()))
 
         # flush fact cache if requested
         if self.options.flush_cache:
             PlaybookCLI._flush_cache(inventory, variable_manager)
+        if self.options.fact_caching:
+            hosts = inventory.list_hosts()
+            hits = len([h for h in hosts if h.get_name() in variable_manager._fact_cache])
+            self.report['fact_cache_hits'] = hits
+            self.report['fact_cache_misses'] = len(hosts) - hits
 
-        # Setup playbook executor, but don't run until run() called
-        playbook = PlaybookExecutor(
-            playbooks=[playbook_path],
-            inventory=inventory,
-            variable_manager=variable_manager,
-            loader=loader,
-            options=self.options,
-            passwords=passwords
-        )
-        display.verbosity = self.options.verbosity
-
-        # Results of PlaybookExecutor
-        results = ""
+        # Defaults of ansible classes changed for this run
+        playbook = None
+        defaults = (Play._attributes['strategy'], PlayContext._attributes['pipelining'])
         try:
-            results = playbook.run()
-        except AnsibleError as e:
-            msg = "Error running playbook '%s': %s" % (playbook_path, str(e))
-            self.logger.error(msg)
-            rcode = 1
-        else:
-            self.logger.info("Done '%s'" % playbook_path)
+            if self.options.strategy:
+                PlaybookCLI._strategy(self.options.strategy)
+            if self.options.pipelining:
+                PlaybookCLI._pipelining(inventory, self.options.no_pipelining)
+
+            # Setup playbook executor, but don't run until run() called
+            with self.tracer.span("playbook_executor"):
+                playbook = PlaybookExecutor(
+                    playbooks=[playbook_path],
+                    inventory=inventory,
+                    variable_manager=variable_manager,
+                    loader=loader,
+                    options=self.options,
+                    passwords=passwords
+                )
+            display.verbosity = self.options.verbosity
+
+            # Results of PlaybookExecutor
+            results = ""
+            try:
+                with self.tracer.span("playbook_run"):
+                    results = playbook.run()
+            except AnsibleError as e:
+                msg = "Error running playbook '%s': %s" % (playbook_path, str(e))
+                self.logger.error(msg)
+                rcode = 1
+            else:
+                self.logger.info("Done '%s'" % playbook_path)
+        finally:
+            Play._attributes['strategy'], PlayContext._attributes['pipelining'] = defaults
+            if playbook is not None:
+                PlaybookCLI._flush_output(playbook._tqm)
 
         stats = playbook._tqm._stats
+        if self.tracer.enabled:
+            self.report['trace'] = self.tracer.events
+        if self.options.artifact_facts:
+            facts = {}
+            for host in inventory.list_hosts():
+                if host.get_name() in variable_manager._fact_cache:
+                    facts[host.get_name()] = variable_manager._fact_cache[host.get_name()]
+            self.report['facts'] = facts
         return rcode, results, stats
 
     @staticmethod
@@ -158,3 +212,100 @@ class PlaybookCLI(CLI):
         for host in inventory.list_hosts():
             hostname = host.get_name()
             variable_manager.clear_facts(hostname)
+
+    def _inventory(self, loader):
+        if self.options.inventory_cache:
+            inventory = CachedInventoryManager(
+                loader=loader, sources=self.options.inventory, cache=self.options.inventory_cache)
+            self.report['inventory_cache'] = "hit" if inventory.cache_hit else "miss"
+        else:
+            inventory = InventoryManager(loader=loader, sources=self.options.inventory)
+        if self.options.subset:
+            inventory.subset(self.options.subset)
+        return inventory
+
+    def list_hosts(self):
+        """Names of the inventory hosts the playbook would run on"""
+        inventory = self._inventory(DataLoader())
+        return [h.get_name() for h in inventory.list_hosts()]
+
+    def connections(self):
+        """Connection settings (connection, host, port, user and private
+        key) of the inventory hosts of the run, from their variables
+        """
+        loader = DataLoader()
+        inventory = self._inventory(loader)
+        variable_manager = VariableManager(loader=loader, inventory=inventory)
+        if self.options.extra_vars:
+            variable_manager.extra_vars = load_extra_vars(loader=loader, options=self.options)
+        result = {}
+        for host in inventory.list_hosts():
+            hostvars = variable_manager.get_vars(host=host, include_hostvars=False)
+            templar = Templar(loader=loader, variables=hostvars)
+
+            def var(names, default=None):
+                for name in names:
+                    if name in hostvars:
+                        return templar.template(hostvars[name])
+                return default
+
+            result[host.get_name()] = {
+                "connection": var(["ansible_connection"], self.options.connection),
+                "host": var(["ansible_host", "ansible_ssh_host"], host.address),
+                "port": var(["ansible_port", "ansible_ssh_port"]),
+                "user": var(["ansible_user", "ansible_ssh_user"], self.options.remote_user),
+                "private_key_file": var(["ansible_private_key_file", "ansible_ssh_private_key_file"],
+                                        self.options.private_key_file),
+            }
+        return result
+
+    @staticmethod
+    def merge_stats(stats_list):
+        """Aggregates the stats of several playbook runs"""
+        merged = AggregateStats()
+        for stats in stats_list:
+            for what in ['processed', 'failures', 'ok', 'dark', 'changed', 'skipped']:
+                counters = getattr(merged, what)
+                for host, value in getattr(stats, what).items():
+                    counters[host] = counters.get(host, 0) + value
+            for host, custom in stats.custom.items():
+                for which, what in custom.items():
+                    merged.update_custom_stats(which, what, host)
+        for host in merged.processed:
+            merged.processed[host] = 1
+        return merged
+
+    @staticmethod
+    def _strategy(name):
+        # Strategy of the plays which do not define one, the default of
+        # the play attribute is taken from C.DEFAULT_STRATEGY on import
+        Play._attributes['strategy'] = name
+
+    @staticmethod
+    def _flush_output(tqm):
+        # Buffered output of the stdout callback, v2_playbook_on_stats
+        # (which flushes it) is not called when the run is aborted and
+        # pool processes exit without atexit handlers
+        output = getattr(getattr(tqm, '_stdout_callback', None), '_display', None)
+        if hasattr(output, 'flush'):
+            output.flush()
+
+    @staticmethod
+    def _pipelining(inventory, fallback):
+        # The default of the play context attribute is taken from
+        # C.ANSIBLE_PIPELINING on import, the hosts which cannot use it
+        # fall back with the host variable
+        PlayContext._attributes['pipelining'] = True
+        for name in fallback:
+            host = inventory.get_host(name)
+            if host is not None:
+                host.set_variable('ansible_pipelining', False)
+
+    @staticmethod
+    def _fact_caching(path, timeout):
+        # One json file per host, facts are only gathered again for the
+        # hosts without file or when it is older than timeout
+        C.CACHE_PLUGIN = 'jsonfile'
+        C.CACHE_PLUGIN_CONNECTION = path
+        C.CACHE_PLUGIN_TIMEOUT = int(timeout)
+        C.DEFAULT_GATHERING = 'smart'
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 :
+
+# concourse-ansible-resource - playbook_pool.py
+# 18/10/2026
+
+import time
+
+import multiprocessing
+from multiprocessing.connection import wait
+
+
+class PlaybookPool(object):
+    """Runs jobs in child processes, at most `max_parallel` at the same
+    time. A job is a dictionary with a `name`, the `args` for the target
+    function and optionally the list of job names it `requires`.
+
+    Child processes are not daemonic, ansible needs to fork its workers.
+    """
+
+    def __init__(self, logger, max_parallel=1):
+        self.logger = logger
+        self.max_parallel = max(1, int(max_parallel))
+        self.context = multiprocessing.get_context('fork')
+        # Seconds each job took
+        self.durations = {}
+
+    @staticmethod
+    def _child(target, args, conn):
+        try:
+            value = target(args)
+        except Exception as e:
+            value = e
+        conn.send(value)
+        conn.close()
+
+    def _start(self, job, target):
+        reader, writer = self.context.Pipe(duplex=False)
+        proc = self.context.Process(
+            target=self._child, args=(target, job['args'], writer), name=job['name'])
+        proc.start()
+        writer.close()
+        self.durations[job['name']] = time.time()
+        self.logger.info("Started job '%s', pid=%d" % (job['name'], proc.pid))
+        return reader, proc
+
+    def _finish(self, job, reader, proc):
+        try:
+            value = reader.recv()
+        except EOFError:
+            value = RuntimeError("Job '%s' finished without result" % job['name'])
+        reader.close()
+        proc.join()
+        self.durations[job['name']] = time.time() - self.durations[job['name']]
+        if isinstance(value, Exception):
+            msg = "Job '%s' failed: %s" % (job['name'], str(value))
+            self.logger.error(msg)
+        else:
+            self.logger.info("Finished job '%s', rcode=%s" % (job['name'], proc.exitcode))
+        return value
+
+    def run(self, jobs, target, ok=None, stop=None):
+        """Runs `target(job['args'])` for all jobs and returns a dictionary
+        with the value returned for each job name (an exception if it failed
+        or None if it was not executed).
+
+        `ok(value)` tells if the dependent jobs can run, `stop(results)` is
+        checked before starting a job and if true, pending jobs are skipped.
+        """
+        names = [job['name'] for job in jobs]
+        if len(set(names)) != len(names):
+            msg = "Job names are not unique: %s" % names
+            self.logger.error(msg)
+            raise ValueError(msg)
+        for job in jobs:
+            for name in job.get('requires', []):
+                if name not in names:
+                    msg = "Job '%s' requires unknown job '%s'" % (job['name'], name)
+                    self.logger.error(msg)
+                    raise ValueError(msg)
+        if ok is None:
+            ok = lambda value: not isinstance(value, Exception)
+        results = {}
+        pending = list(jobs)
+        running = {}
+        while pending or running:
+            stopped = stop is not None and stop(results)
+            # Skipped jobs skip the ones requiring them, until no more changes
+            skipped = True
+            while skipped:
+                skipped = False
+                for job in list(pending):
+                    if stopped or any(
+                            name in results and not (results[name] is not None and ok(results[name]))
+                            for name in job.get('requires', [])):
+                        self.logger.warning("Skipping job '%s'" % job['name'])
+                        results[job['name']] = None
+                        pending.remove(job)
+                        skipped = True
+            for job in list(pending):
+                if len(running) >= self.max_parallel:
+                    break
+                if all(name in results for name in job.get('requires', [])):
+                    reader, proc = self._start(job, target)
+                    running[reader] = (job, proc)
+                    pending.remove(job)
+            if not running:
+                if pending:
+                    msg = "Cyclic dependencies between jobs: %s" % [j['name'] for j in pending]
+                    self.logger.error(msg)
+                    raise ValueError(msg)
+                break
+            for reader in wait(list(running.keys())):
+                job, proc = running.pop(reader)
+                results[job['name']] = self._finish(job, reader, proc)
+        return results
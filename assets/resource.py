@@ -9,8 +9,8 @@ import argparse
 import json
 import logging
 import os
-import subprocess
-import tempfile
+
+from tracer import Tracer
 
 __program__ = "concourse-resource-type"
 __version__ = "v0.1.0"
@@ -20,19 +20,41 @@ __email__ = "jose.riguera@springernature.com"
 __license__ = "MIT"
 __purpose__ = "Concourse resource"
 
+# Keys whose values are never logged
+SECRETS = ["private_key", "src_private_key", "vault_password", "become_pass", "remote_pass"]
+
+
+def redact(data, secrets=SECRETS):
+    """Copy of `data` (dictionaries and lists) without the secret values"""
+    if isinstance(data, dict):
+        return dict(
+            (k, "********" if k in secrets and v else redact(v, secrets))
+            for k, v in data.items())
+    if isinstance(data, list):
+        return [redact(v, secrets) for v in data]
+    return data
+
 
 class Resource(object):
     """Base resource implementation."""
     LOGFORMAT = '%(name)s: %(message)s'
     LOGGING = "logging.ini"
-    LOGLEVEL = logging.DEBUG
+    LOGLEVEL = logging.INFO
     LOGENVCONF = "RESOURCE_CONFIGLOG"
+    LOGENVLEVEL = "RESOURCE_LOGLEVEL"
+    LOGFILE = "concourse-resource.log"
+    LOGFILE_SIZE = 10 * 1024 * 1024
+    LOGFILE_BACKUPS = 2
     DEBUG = "RESOURCE_DEBUG"
 
     def __init__(self, arguments=None, logging_config=None):
+        # Timing of the phases, only kept if `trace` is requested
+        self.tracer = Tracer()
         # By default ansible logfile is used
-        args = self._args(arguments)
-        self._logging(logging_config)
+        with self.tracer.span("args"):
+            args = self._args(arguments)
+        with self.tracer.span("logging"):
+            self._logging(logging_config)
         self.fdin = args.infile
         self.fdout = args.outfile
         self.workfolder = args.workfolder
@@ -41,25 +63,55 @@ class Resource(object):
         logconf = False
         logpath = os.environ.get(self.LOGENVCONF, config)
         if logpath:
+            from logging.config import fileConfig
+
             logpath = os.path.expandvars(logpath)
             try:
-                logging.config.fileConfig(logpath)
+                fileConfig(logpath)
             except Exception as e:
                 print("Error '%s': %s" % (logpath, e), file=sys.stderr)
                 logging.basicConfig(level=self.LOGLEVEL, format=self.LOGFORMAT)
             else:
                 logconf = True
         else:
-            logfile = tempfile.NamedTemporaryFile(delete=False, prefix='log')
-            logging.basicConfig(
-                level=logging.DEBUG,
-                format=self.LOGFORMAT,
-                filename=logfile.name)
-        if os.environ.get(self.DEBUG, "0").lower() in ['1', 'yes', 'true', 'y']:
+            import tempfile
+            from logging.handlers import RotatingFileHandler
+
+            # Size bounded, shared by all the runs in the container. The
+            # ansible display (imported first by `out`) can have set the
+            # root logger to its `log_path` file, which is rotated too
+            root = logging.getLogger()
+            for handler in list(root.handlers):
+                if type(handler) is logging.FileHandler:
+                    logfile = RotatingFileHandler(
+                        handler.baseFilename, maxBytes=self.LOGFILE_SIZE,
+                        backupCount=self.LOGFILE_BACKUPS, delay=True)
+                    logfile.setFormatter(handler.formatter)
+                    for log_filter in handler.filters:
+                        logfile.addFilter(log_filter)
+                    root.removeHandler(handler)
+                    handler.close()
+                    root.addHandler(logfile)
+            if not root.handlers:
+                logfile = RotatingFileHandler(
+                    os.path.join(tempfile.gettempdir(), self.LOGFILE),
+                    maxBytes=self.LOGFILE_SIZE, backupCount=self.LOGFILE_BACKUPS, delay=True)
+                logfile.setFormatter(logging.Formatter(self.LOGFORMAT))
+                root.addHandler(logfile)
+            root.setLevel(logging.DEBUG)
+        debug = os.environ.get(self.DEBUG, "0").lower() in ['1', 'yes', 'true', 'y']
+        if debug:
             stderr = logging.StreamHandler()
             stderr.setLevel(level=logging.DEBUG)
             logging.getLogger().addHandler(stderr)
         self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.setLevel(logging.DEBUG if debug else self.LOGLEVEL)
+        level = os.environ.get(self.LOGENVLEVEL)
+        if level:
+            if isinstance(logging.getLevelName(level.upper()), int):
+                self.logger.setLevel(level.upper())
+            else:
+                self.logger.warning("Invalid %s '%s', ignoring it" % (self.LOGENVLEVEL, level))
         self.logger.info("Initializing " + str(self.__class__.__name__))
         if not logconf:
             self.logger.info("Using default logging settings")
@@ -99,13 +151,15 @@ class Resource(object):
         source = input.get('source', {})
         params = input.get('params', {})
         version = input.get('version', {})
+        if not (source.get('trace') or params.get('trace')):
+            self.tracer.enabled = False
+            self.tracer.events = []
         # Debug
-        if source.get('debug', False):
-            self.logger.setLevel(logging.DEBUG)
-        self.logger.debug('command: "%s"', command)
-        self.logger.debug('input: "%s"', input)
-        self.logger.debug('folder: "%s"', self.workfolder)
-        self.logger.debug('environment: %s', os.environ)
+        self.log_level(source)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('command: "%s"', command)
+            self.logger.debug('input: "%s"', redact(input))
+            self.logger.debug('folder: "%s"', self.workfolder)
         if command == 'check':
             try:
                 rcode, response = self.check(source, version)
@@ -147,6 +201,16 @@ class Resource(object):
         self.fdout.write(str(output) + '\n')
         return rcode
 
+    def log_level(self, source):
+        """Sets the level of the logger from `debug` or `log_level`"""
+        level = "DEBUG" if source.get('debug', False) else source.get('log_level')
+        if level:
+            if not isinstance(logging.getLevelName(str(level).upper()), int):
+                msg = "Invalid log_level '%s'" % level
+                self.logger.error(msg)
+                raise ValueError(msg)
+            self.logger.setLevel(str(level).upper())
+
     def metadata(self, result):
         metadata = []
         for k in result.keys():
@@ -154,6 +218,8 @@ class Resource(object):
         return metadata
 
     def process(self, cmd=[], input=None, timeout=None):
+        import subprocess
+
         proc = subprocess.Popen(cmd,
                                 stdin=subprocess.PIPE,
                                 stdout=subprocess.PIPE,
@@ -166,8 +232,8 @@ class Resource(object):
                 'Process %d killed with timeout %s' % (proc.pid, str(timeout)))
             proc.kill()
             output, err = proc.communicate()
-        self.logger.debug("stdout: " + repr(output))
-        self.logger.debug("stderr: " + repr(err))
+        self.logger.debug("stdout: %r", output)
+        self.logger.debug("stderr: %r", err)
         stdout = output.decode('utf-8')
         stderr = err.decode('utf-8')
         if proc.returncode != 0:
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 :
+
+# concourse-ansible-resource - ssh_broker.py
+# 18/10/2026
+
+import sys
+import time
+
+import argparse
+import hashlib
+import logging
+import os
+import subprocess
+
+
+class SSHBroker(object):
+    """Keeps ssh ControlMaster sockets in a folder shared between builds,
+    so successive runs reuse already authenticated connections. A detached
+    broker process checks the sockets and evicts the idle ones.
+    """
+    PIDFILE = "broker.pid"
+    INTERVAL = 30
+    IDLE = 600
+
+    def __init__(self, path, logger, idle=IDLE):
+        self.path = path
+        self.logger = logger
+        self.idle = idle
+
+    def control_dir(self, private_key=None):
+        """Folder for the sockets of a private key, the socket names
+        are hashes of (host, port, user).
+        """
+        key = private_key or ""
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+        path = os.path.join(self.path, name)
+        if not os.path.exists(path):
+            os.makedirs(path, 0o700)
+        return path
+
+    def ssh_args(self, control_dir):
+        # Masters outlive the broker for a while, but it is the broker
+        # which evicts them after `idle` seconds without being used.
+        persist = 2 * self.idle
+        return "-C -o ControlMaster=auto -o ControlPersist=%ds -o ControlPath=%s" % (
+            persist, os.path.join(control_dir, "%C"))
+
+    def sockets(self, control_dir=None):
+        folders = [control_dir] if control_dir else [
+            os.path.join(self.path, d) for d in os.listdir(self.path)
+            if os.path.isdir(os.path.join(self.path, d))
+        ]
+        result = []
+        for folder in folders:
+            for name in os.listdir(folder):
+                result.append(os.path.join(folder, name))
+        return result
+
+    def _control(self, socket, command):
+        cmd = ["ssh", "-O", command, "-o", "ControlPath=%s" % socket, "broker"]
+        try:
+            rcode = subprocess.call(
+                cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=10)
+        except subprocess.TimeoutExpired:
+            rcode = -1
+        return rcode == 0
+
+    def alive(self, socket):
+        return self._control(socket, "check")
+
+    def _remove(self, socket):
+        try:
+            os.remove(socket)
+        except OSError:
+            pass
+
+    def pid(self):
+        try:
+            with open(os.path.join(self.path, self.PIDFILE)) as f:
+                pid = int(f.read().strip())
+            os.kill(pid, 0)
+        except (OSError, ValueError):
+            return None
+        return pid
+
+    def start(self):
+        """Starts the broker process, unless there is one running."""
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, 0o700)
+        pid = self.pid()
+        if pid:
+            self.logger.info("Reusing ssh broker, pid=%d" % pid)
+            return pid
+        cmd = [sys.executable, os.path.abspath(__file__), self.path, "--idle", str(self.idle)]
+        proc = subprocess.Popen(
+            cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, close_fds=True, start_new_session=True)
+        self.logger.info("Started ssh broker, pid=%d: %s" % (proc.pid, str(cmd)))
+        return proc.pid
+
+    def warm(self, control_dir):
+        """Returns the number of healthy master connections in
+        `control_dir`, dead sockets are removed.
+        """
+        healthy = 0
+        for socket in self.sockets(control_dir):
+            if self.alive(socket):
+                healthy += 1
+            else:
+                self.logger.debug("Removing dead ssh socket '%s'" % socket)
+                self._remove(socket)
+        return healthy
+
+    def touch(self, control_dir):
+        """Marks the sockets of `control_dir` as used now."""
+        for socket in self.sockets(control_dir):
+            try:
+                os.utime(socket)
+            except OSError:
+                pass
+
+    def evict(self):
+        now = time.time()
+        remaining = 0
+        for socket in self.sockets():
+            try:
+                used = os.stat(socket).st_mtime
+            except OSError:
+                continue
+            if not self.alive(socket):
+                self.logger.info("Removing dead ssh socket '%s'" % socket)
+                self._remove(socket)
+            elif now - used > self.idle:
+                self.logger.info("Closing idle ssh master '%s'" % socket)
+                if not self._control(socket, "exit"):
+                    self._remove(socket)
+            else:
+                remaining += 1
+        return remaining
+
+    def serve(self):
+        """Broker loop, it finishes when there are no connections left."""
+        pidfile = os.path.join(self.path, self.PIDFILE)
+        with open(pidfile, 'w') as f:
+            f.write(str(os.getpid()))
+        self.logger.info("ssh broker running on '%s'" % self.path)
+        started = time.time()
+        while True:
+            time.sleep(self.INTERVAL)
+            if self.pid() != os.getpid():
+                # Another broker took over
+                break
+            remaining = self.evict()
+            if remaining == 0 and time.time() - started > self.idle:
+                break
+        if self.pid() == os.getpid():
+            os.remove(pidfile)
+        self.logger.info("ssh broker finished")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=SSHBroker.__doc__)
+    parser.add_argument('path')
+    parser.add_argument('--idle', type=int, default=SSHBroker.IDLE)
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)s: %(message)s',
+        filename=os.path.join(args.path, "broker.log"))
+    broker = SSHBroker(args.path, logging.getLogger(SSHBroker.__name__), args.idle)
+    broker.serve()
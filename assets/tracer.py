@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 :
+
+# concourse-ansible-resource - tracer.py
+# 18/10/2026
+
+import json
+import os
+import threading
+import time
+
+
+class Span(object):
+    """Context manager which records the duration of a phase"""
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.events.append({
+            "name": self.name,
+            "ts": self.start,
+            "dur": time.time() - self.start,
+            "pid": os.getpid(),
+            "tid": threading.current_thread().ident,
+        })
+        return False
+
+
+class NullSpan(object):
+    """Span of a disabled tracer, does nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class Tracer(object):
+    """Records spans around the phases of a run (a few per run). The
+    spans can be summarized as durations per phase or saved as a chrome
+    trace file (chrome://tracing, perfetto). When disabled `span` returns
+    a shared no-op span.
+    """
+    NULL = NullSpan()
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.events = []
+
+    def span(self, name):
+        if not self.enabled:
+            return self.NULL
+        return Span(self, name)
+
+    def durations(self):
+        """Seconds spent in each phase (added up if it was run several times)"""
+        result = {}
+        for event in self.events:
+            result[event["name"]] = result.get(event["name"], 0) + event["dur"]
+        return result
+
+    def save(self, path):
+        events = []
+        for event in sorted(self.events, key=lambda e: e["ts"]):
+            events.append({
+                "name": event["name"],
+                "ph": "X",
+                "ts": int(event["ts"] * 1000000),
+                "dur": int(event["dur"] * 1000000),
+                "pid": event["pid"],
+                "tid": event["tid"],
+            })
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return path
@@ -33,6 +33,33 @@ EOM
   echo "$result" # to be passed into jq -e
 }
 
+test_check_importtime() {
+  set -e
+  base_dir="$(cd "$(dirname $0)" ; pwd )"
+  if [ -f "${base_dir}/../assets/check" ] ; then
+    cmd="../assets/check"
+  elif [ -f /opt/resource/check ] ; then
+    cmd="/opt/resource/check"
+  fi
+  # Budget of the imports of check, in microseconds
+  budget="${CHECK_IMPORT_BUDGET:-100000}"
+
+  cat <<EOM >&2
+------------------------------------------------------------------------------
+TESTING: check import time (budget ${budget}us)
+EOM
+
+  imports="$(cd $base_dir && echo '{"source": {}}' | python3 -X importtime $cmd 2>&1 >/dev/null | grep '^import time:')"
+  heavy="$(echo "$imports" | awk -F'|' '$3 ~ /^ *(ansible|git)(\.|$)/ {print $3}')"
+  if [ -n "$heavy" ] ; then
+    echo >&2 "check imports ansible or git:" $heavy
+    return 1
+  fi
+  total="$(echo "$imports" | awk -F'|' '$1 ~ /[0-9]/ {split($1, a, ":"); sum += a[2]} END {print sum}')"
+  echo >&2 "Imports: ${total}us"
+  [ "$total" -le "$budget" ]
+}
+
 # Env variables
 export BUILD_PIPELINE_NAME='my-pipeline'
 export BUILD_JOB_NAME='my-job'
@@ -42,5 +69,6 @@ export BUILD_TEAM_NAME='main'
 export RESOURCE_DEBUG=1
 
 # TESTS
+test_check_importtime
 test_out playbook.yml out
 
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+"""
+Benchmark of the `out` path on synthetic fleets, without network: the
+hosts use the local connection and the playbook only has set_fact and
+debug tasks (which run on the controller). Each phase of
+AnsiblePlaybook.update is timed and the results are printed (or saved)
+as json, to compare them between builds. Phases are nested: configure
+includes inventory, which includes hosts (the rendering of the file).
+
+Without --run only the inventory rendering and parsing, summarize and
+metadata are measured (on fake stats), which works for big fleets.
+"""
+import sys
+import time
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+ASSETS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "assets")
+sys.path.insert(0, ASSETS)
+# Output of the playbook is not part of the benchmark
+os.environ.setdefault("ANSIBLE_STDOUT_CALLBACK", "null")
+
+from ansible import __version__ as ansible_version
+from ansible.executor.stats import AggregateStats
+from ansible.utils.display import Display
+
+display = Display()
+
+from ansible_playbook import AnsiblePlaybook
+from playbook_cli import PlaybookCLI
+
+PHASES = ["configure", "inventory", "hosts", "run_playbook", "summarize", "metadata"]
+
+
+class Timer(object):
+    """Wraps methods of an object to add up the seconds spent on them"""
+
+    def __init__(self, obj, names):
+        self.times = dict((name, 0.0) for name in names)
+        for name in names:
+            setattr(obj, name, self._wrap(name, getattr(obj, name)))
+
+    def _wrap(self, name, method):
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.times[name] += time.time() - start
+        return timed
+
+
+def playbook(path, tasks):
+    with open(path, 'w') as f:
+        f.write("- hosts: fleet\n  gather_facts: false\n  tasks:\n")
+        for n in range(tasks):
+            if n % 2:
+                f.write("  - debug: msg=\"{{ value%d }}\" verbosity=1\n" % (n - 1))
+            else:
+                f.write("  - set_fact: value%d=\"{{ inventory_hostname }}-%d\"\n" % (n, n))
+
+
+def params(hosts, fmt, forks):
+    return {
+        "src": ".",
+        "playbook": "playbook.yml",
+        "forks": forks,
+        "inventory": {
+            "file": "inventory" + AnsiblePlaybook.INVENTORY_FORMATS[fmt],
+            "format": fmt,
+            "hosts": {
+                "fleet": {
+                    "hosts": ["host%05d" % n for n in range(hosts)],
+                    "vars": {
+                        "ansible_connection": "local",
+                        "ansible_python_interpreter": sys.executable,
+                    },
+                },
+            },
+        },
+    }
+
+
+def fake_stats(hosts):
+    stats = AggregateStats()
+    for n in range(hosts):
+        host = "host%05d" % n
+        stats.increment('ok', host)
+        if n % 10 == 0:
+            stats.increment('changed', host)
+        if n % 100 == 0:
+            stats.increment('failures', host)
+    return stats
+
+
+def bench(hosts, tasks, fmt, forks, run):
+    folder = tempfile.mkdtemp(prefix="bench")
+    try:
+        playbook(os.path.join(folder, "playbook.yml"), tasks)
+        r = AnsiblePlaybook([folder])
+        timer = Timer(r, PHASES)
+        start = time.time()
+        if run:
+            rcode, response = r.update(folder, {}, params(hosts, fmt, forks))
+            if rcode != 0:
+                raise RuntimeError("Playbook failed on %d hosts: %s" % (hosts, response))
+        else:
+            config = r.configure(folder, {}, params(hosts, fmt, forks))
+            start_parse = time.time()
+            PlaybookCLI(config, r.logger).list_hosts()
+            timer.times["parse"] = time.time() - start_parse
+            result = r.summarize(fake_stats(hosts), os.path.join(folder, r.SUMMARY_FILE))
+            r.metadata(0, result)
+        total = time.time() - start
+    finally:
+        shutil.rmtree(folder)
+    phases = dict((k, round(v, 4)) for k, v in timer.times.items())
+    return {"hosts": hosts, "tasks": tasks, "format": fmt, "run": run,
+            "phases": phases, "total": round(total, 4)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--hosts', default="100,1000,10000,50000",
+                        help="comma separated fleet sizes")
+    parser.add_argument('--tasks', type=int, default=10)
+    parser.add_argument('--format', default="ini", choices=sorted(AnsiblePlaybook.INVENTORY_FORMATS))
+    parser.add_argument('--forks', type=int, default=10)
+    parser.add_argument('--run', action='store_true', help="run the playbook")
+    parser.add_argument('--output', help="json file for the results")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    results = []
+    for hosts in [int(h) for h in args.hosts.split(',')]:
+        result = bench(hosts, args.tasks, args.format, args.forks, args.run)
+        sys.stderr.write("%s\n" % json.dumps(result))
+        results.append(result)
+    report = {
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "ansible": ansible_version,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+"""
+Startup time of the resource: a cold process importing ansible (as `out`
+does), the `check` script (which must not import ansible) and a request
+served by a warm fork server. Prints the timings as json.
+"""
+import sys
+import time
+
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+
+ASSETS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "assets")
+INPUT = json.dumps({"source": {}}).encode('utf-8')
+
+COLD = """
+import sys
+sys.path.insert(0, %r)
+import playbook_cli
+from forkserver import run
+sys.exit(run('check', ['.']))
+""" % ASSETS
+
+WARM = """
+import sys
+sys.path.insert(0, %r)
+from forkserver import ForkServer
+rcode = ForkServer.request('check', ['check', '.'], %r)
+sys.exit(2 if rcode is None else rcode)
+"""
+
+IMPORTS = """
+import sys
+sys.path.insert(0, %r)
+import ansible_playbook
+print(sorted(m for m in sys.modules if m == 'ansible' or m.startswith('ansible.')))
+""" % ASSETS
+
+
+def timed(cmd, runs):
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        subprocess.run(cmd, input=INPUT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.time() - start)
+    return round(min(times), 4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    imported = subprocess.check_output([sys.executable, "-c", IMPORTS]).decode('utf-8').strip()
+    if imported != "[]":
+        sys.stderr.write("check and in import ansible: %s\n" % imported)
+        return 1
+    result = {
+        "cold": timed([sys.executable, "-c", COLD], args.runs),
+        "check": timed([sys.executable, os.path.join(ASSETS, "check"), "."], args.runs),
+    }
+    path = os.path.join(tempfile.mkdtemp(), "forkserver.sock")
+    server = subprocess.Popen([sys.executable, os.path.join(ASSETS, "forkserver.py"), path, "--idle", "60"])
+    try:
+        while not os.path.exists(path):
+            time.sleep(0.1)
+            if server.poll() is not None:
+                sys.stderr.write("Fork server failed\n")
+                return 1
+        result["warm"] = timed([sys.executable, "-c", WARM % (ASSETS, path)], args.runs)
+    finally:
+        server.terminate()
+        server.wait()
+    print(json.dumps(result))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
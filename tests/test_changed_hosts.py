@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+"""
+Tests of AnsiblePlaybook.changed_hosts, the hosts and groups of the
+inline inventory changed between two runs (`limit_changed`).
+"""
+import sys
+import unittest
+
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "assets"))
+
+from ansible_playbook import AnsiblePlaybook
+
+changed_hosts = AnsiblePlaybook.changed_hosts
+
+STATE = {
+    "web": {"hosts": {"h1": {}, "h2": {"port": 22}}, "vars": {"app": "1"}},
+    "db": {"hosts": {"d1": {}}, "vars": {"engine": "pg"}, "children": {"replicas": {}}},
+    "replicas": {"hosts": {"r1": {}}},
+}
+
+
+def state(**groups):
+    result = dict((name, dict(group)) for name, group in STATE.items())
+    result.update(groups)
+    return result
+
+
+class ChangedHostsTest(unittest.TestCase):
+
+    def test_unchanged(self):
+        self.assertEqual(changed_hosts(STATE, state()), [])
+
+    def test_added_host(self):
+        current = state(web={"hosts": {"h1": {}, "h2": {"port": 22}, "h3": {}}, "vars": {"app": "1"}})
+        self.assertEqual(changed_hosts(STATE, current), ["h3"])
+
+    def test_removed_host(self):
+        current = state(web={"hosts": {"h1": {}}, "vars": {"app": "1"}})
+        self.assertEqual(changed_hosts(STATE, current), [])
+
+    def test_host_variables(self):
+        current = state(web={"hosts": {"h1": {}, "h2": {"port": 2222}}, "vars": {"app": "1"}})
+        self.assertEqual(changed_hosts(STATE, current), ["h2"])
+
+    def test_host_moved_to_other_group(self):
+        current = state(web={"hosts": {"h2": {"port": 22}}, "vars": {"app": "1"}},
+                        replicas={"hosts": {"r1": {}, "h1": {}}})
+        self.assertEqual(changed_hosts(STATE, current), ["h1"])
+
+    def test_group_variables(self):
+        current = state(web={"hosts": {"h1": {}, "h2": {"port": 22}}, "vars": {"app": "2"}})
+        self.assertEqual(changed_hosts(STATE, current), ["web"])
+
+    def test_group_children(self):
+        current = state(db={"hosts": {"d1": {}}, "vars": {"engine": "pg"}})
+        self.assertEqual(changed_hosts(STATE, current), ["db"])
+
+    def test_new_group(self):
+        current = state(cache={"hosts": {"c1": {}}})
+        self.assertEqual(changed_hosts(STATE, current), ["c1", "cache"])
+
+    def test_no_previous_state(self):
+        self.assertEqual(changed_hosts({}, STATE), ["d1", "db", "h1", "h2", "r1", "replicas", "web"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+"""
+Tests of PlaybookPool: dependencies between jobs, failures and skips.
+"""
+import sys
+import unittest
+
+import logging
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "assets"))
+
+from playbook_pool import PlaybookPool
+
+logger = logging.getLogger("PlaybookPool")
+
+
+def target(args):
+    # Returns the name of the job, or fails
+    if args.get("fail"):
+        raise ValueError("%s failed" % args["name"])
+    return args["name"]
+
+
+def job(name, requires=(), fail=False):
+    return {"name": name, "args": {"name": name, "fail": fail}, "requires": list(requires)}
+
+
+class PlaybookPoolTest(unittest.TestCase):
+
+    def run_jobs(self, jobs, max_parallel=2, **kwargs):
+        return PlaybookPool(logger, max_parallel).run(jobs, target, **kwargs)
+
+    def test_independent_jobs(self):
+        results = self.run_jobs([job("a"), job("b"), job("c")])
+        self.assertEqual(results, {"a": "a", "b": "b", "c": "c"})
+
+    def test_chain(self):
+        results = self.run_jobs([job("c", ["b"]), job("b", ["a"]), job("a")])
+        self.assertEqual(results, {"a": "a", "b": "b", "c": "c"})
+
+    def test_failure(self):
+        results = self.run_jobs([job("a", fail=True), job("b")])
+        self.assertIsInstance(results["a"], ValueError)
+        self.assertEqual(results["b"], "b")
+
+    def test_failure_skips_chain(self):
+        for jobs in ([job("c", ["b"]), job("b", ["a"]), job("a", fail=True)],
+                     [job("a", fail=True), job("b", ["a"]), job("c", ["b"])]):
+            results = self.run_jobs(jobs, max_parallel=1)
+            self.assertIsInstance(results["a"], ValueError)
+            self.assertIsNone(results["b"])
+            self.assertIsNone(results["c"])
+
+    def test_failure_skips_dependents_only(self):
+        results = self.run_jobs([job("a", fail=True), job("b", ["a"]), job("c"), job("d", ["c"])])
+        self.assertIsNone(results["b"])
+        self.assertEqual(results["d"], "d")
+
+    def test_not_ok(self):
+        results = self.run_jobs([job("a"), job("b", ["a"])], ok=lambda value: value != "a")
+        self.assertIsNone(results["b"])
+
+    def test_stop(self):
+        results = self.run_jobs([job("a"), job("b", ["a"]), job("c", ["a"])],
+                                stop=lambda results: "a" in results)
+        self.assertEqual(results, {"a": "a", "b": None, "c": None})
+
+    def test_cyclic_dependencies(self):
+        with self.assertRaises(ValueError):
+            self.run_jobs([job("a", ["b"]), job("b", ["a"])])
+
+    def test_unknown_dependency(self):
+        with self.assertRaises(ValueError):
+            self.run_jobs([job("a", ["x"])])
+
+    def test_duplicated_names(self):
+        with self.assertRaises(ValueError):
+            self.run_jobs([job("a"), job("a")])
+
+
+if __name__ == '__main__':
+    unittest.main()